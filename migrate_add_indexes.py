@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+为已有数据库补建 models 中声明的索引（create_all 不会给已存在的表加索引）
+用法（服务器上）：
+  cd /home/app/apps/batch_ai_video
+  source venv/bin/activate
+  python migrate_add_indexes.py
+"""
+
+import sys
+import os
+
+# Add current directory to sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import LargeBinary, inspect
+
+from server.db import engine, Base
+from server import models  # noqa: F401
+
+
+def _rebuild_sessions_if_needed():
+    """sessions.id 由字符串改为 16 字节二进制、新增 expires_at_epoch：旧表直接重建（已登录用户需重新登录）"""
+    insp = inspect(engine)
+    if not insp.has_table("sessions"):
+        return
+    columns = {c["name"]: c for c in insp.get_columns("sessions")}
+    if isinstance(columns["id"]["type"], LargeBinary) and "expires_at_epoch" in columns:
+        return
+    print("[migrate] 重建 sessions 表（id 改为 BINARY(16)，新增 expires_at_epoch）...")
+    table = models.UserSession.__table__
+    table.drop(bind=engine)
+    table.create(bind=engine)
+
+
+def migrate():
+    _rebuild_sessions_if_needed()
+    for table in Base.metadata.sorted_tables:
+        table.create(bind=engine, checkfirst=True)
+        for index in table.indexes:
+            print(f"[migrate] 检查索引 {table.name}.{index.name} ...")
+            index.create(bind=engine, checkfirst=True)
+    print("[migrate] ✅ 索引补建完成")
+
+
+if __name__ == "__main__":
+    migrate()
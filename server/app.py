@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import os
 import hashlib
+import hmac
+import logging
 import re
 import secrets
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict
+from datetime import timedelta
 from io import BytesIO
 import time
 import uuid
@@ -13,26 +17,35 @@ from pathlib import Path
 from typing import List, Optional
 
 from fastapi import Depends, FastAPI, File, HTTPException, Request, Response, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
-from sqlalchemy.orm import Session
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session, selectinload
  
 
-from .batch_utils import recompute_batch_counters
+from .batch_utils import recompute_batch_counters, record_task_change, record_task_transition, refund_task_once
 from .cleanup import cleanup_loop
-from .db import get_db, init_db
-from .models import Batch, IdempotencyKey, Task, TaskStatus, User, CreditTransaction, SmsVerifySession
+from .db import get_db, init_db, insert_ignore
+from .models import Batch, IdempotencyKey, Task, TaskStatus, User, CreditTransaction, SmsVerifySession, ProcessedStripeEvent, utcnow
 from .queue import executor
 from .rate_limit import rate_limiter
 from .pricing import get_unit_cost
 from .schemas import (
     ApiResponse,
     BatchCreateRequest,
+    BatchPage,
+    BatchPageResponse,
     BatchRead,
     CreditAdjustRequest,
     LoginRequest,
+    MeApiResponse,
     MeResponse,
+    TaskListResponse,
     TaskRead,
     SmsSendRequest,
     SmsVerifyRequest,
@@ -42,26 +55,34 @@ from .schemas import (
     CreditTransactionRead,
     fail,
     ok,
+    ok_json,
 )
 from .security import (
     clear_session_cookie,
     create_session,
     get_current_user,
     hash_password,
+    password_needs_rehash,
+    revoke_session,
     set_session_cookie,
-    verify_password,
+    verify_user_password,
 )
 from .settings import settings
 from .crypto import encrypt_text
 from .models import UserApiKey, RechargeOrder
 from .providers.aliyun_sms import client as sms_client, AliyunSmsError
 from .sms_rate_limit import ensure_sms_rate_limit
+from .redis_client import get_async_redis
 from .providers.payment import payment_service
+from .providers.yunwu import callback_signature as yunwu_callback_signature, deliver_callback as deliver_yunwu_callback
+from .providers.yunwu_client import json_loads, parse_task_payload
 from fastapi.responses import HTMLResponse
 from fastapi.responses import RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Video Generation Batch API", docs_url=None, redoc_url=None)
 
 
@@ -95,6 +116,8 @@ else:
 import stripe
 if settings.STRIPE_SECRET_KEY:
     stripe.api_key = settings.STRIPE_SECRET_KEY
+    # 使用基于 httpx 的客户端：在进程内复用连接池（支付路由为同步函数，在线程池中调用 Stripe 与数据库）
+    stripe.default_http_client = stripe.HTTPXClient()
     print("✅ Stripe 支付已配置")
 else:
     print("⚠️  Stripe 支付未配置（STRIPE_SECRET_KEY 未设置）")
@@ -141,12 +164,20 @@ def _ensure_dirs() -> None:
 
 @app.on_event("startup")
 async def on_startup() -> None:
+    logging.basicConfig(level=settings.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     _ensure_dirs()
     init_db()
     _ensure_initial_admin()
     if not settings.DISABLE_BACKGROUND:
         print("[startup] Background executor starting...")
         executor.start()
+        # 计数器日常增量维护，启动时全量对账一次，修正历史数据或异常中断留下的偏差
+        try:
+            from .db import SessionLocal
+            with SessionLocal() as db:
+                recompute_batch_counters(db)
+        except Exception as e:
+            print("[startup] Batch counter reconciliation failed:", e)
         import asyncio
         asyncio.create_task(cleanup_loop())
         print("[startup] Cleanup loop started. Public dir:", settings.PUBLIC_DIR)
@@ -156,13 +187,13 @@ async def on_startup() -> None:
             from .models import Task, TaskStatus
             with SessionLocal() as db:
                 rows = (
-                    db.query(Task.id)
+                    db.query(Task.id, Task.user_id)
                     .filter(Task.status.in_([TaskStatus.pending, TaskStatus.queued]), Task.deleted_at.is_(None))
                     .all()
                 )
                 count = 0
-                for (task_id,) in rows:
-                    executor.enqueue_task(task_id)
+                for task_id, user_id in rows:
+                    executor.enqueue_task(task_id, user_id)
                     count += 1
                 if count:
                     print(f"[startup] Re-enqueued {count} pending/queued tasks")
@@ -195,17 +226,27 @@ def _ensure_initial_admin() -> None:
 @app.post("/api/login")
 def login(req: LoginRequest, response: Response, db: Session = Depends(get_db)) -> ApiResponse[dict]:
     user = db.query(User).filter(User.username == req.username).first()
-    if user is None or not verify_password(req.password, user.password_hash):
+    if not verify_user_password(user, req.password):
         return fail("用户名或密码错误")
     if not user.enabled:
         return fail("账号已禁用")
-    session = create_session(db, user)
-    set_session_cookie(response, session.id)
+    if password_needs_rehash(user.password_hash):
+        # 明文只在登录时可得：借此把旧哈希升级到当前算法/成本（create_session 中一并提交）
+        user.password_hash = hash_password(req.password)
+        db.add(user)
+    token = create_session(db, user)
+    set_session_cookie(response, token)
     return ok({"user_id": user.id, "username": user.username, "is_admin": user.is_admin})
 
 
 @app.post("/api/logout")
-def logout(response: Response, user: User = Depends(get_current_user)) -> ApiResponse[None]:
+def logout(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user),
+) -> ApiResponse[None]:
+    revoke_session(db, request.cookies.get(settings.SESSION_COOKIE_NAME))
     clear_session_cookie(response)
     return ok(None)
 
@@ -293,19 +334,11 @@ async def google_callback(request: Request, response: Response, db: Session = De
         print(f"[google_callback] 用户登录: {email}")
     
     # 创建会话
-    session = create_session(db, user)
+    token = create_session(db, user)
     
     # 创建重定向响应并设置 cookie
     redirect_response = RedirectResponse(url="/", status_code=302)
-    redirect_response.set_cookie(
-        key=settings.SESSION_COOKIE_NAME,
-        value=session.id,
-        httponly=True,
-        max_age=int(settings.SESSION_TTL.total_seconds()),
-        samesite="lax",
-        secure=False,
-        path="/",
-    )
+    set_session_cookie(redirect_response, token)
     return redirect_response
 
 
@@ -317,14 +350,15 @@ def _get_user_credits(db: Session, user_id: int) -> int:
 @app.get("/api/me")
 def me(db: Session = Depends(get_db), user: User = Depends(get_current_user)) -> ApiResponse[MeResponse]:
     credits = _get_user_credits(db, user.id)
-    return ok(
+    return ok_json(
+        MeApiResponse,
         MeResponse(
             user_id=user.id,
             username=user.username,
             is_admin=user.is_admin,
             credits=credits,
             mobile=user.mobile,
-        )
+        ),
     )
 
 
@@ -343,7 +377,7 @@ def upload_image(file: UploadFile = File(...), user: User = Depends(get_current_
             return fail(f"图片尺寸超过 {settings.IMAGE_MAX_EDGE_PX}px")
     except Exception:
         return fail("无效图片")
-    fname = f"{user.id}_{datetime.utcnow().timestamp()}.png"
+    fname = f"{user.id}_{utcnow().timestamp()}.png"
     path = Path(settings.UPLOAD_DIR) / fname
     with open(path, "wb") as f:
         f.write(data)
@@ -441,8 +475,8 @@ def send_mobile_code(
         scene=req.scene or "login",
         sms_session_id=result.sms_session_id,
         code_hash=_hash_sms_code(mobile, result.sms_session_id, result.sms_code),
-        created_at=datetime.utcnow(),
-        expires_at=datetime.utcnow() + timedelta(seconds=settings.SMS_CODE_EXPIRE_SECONDS),
+        created_at=utcnow(),
+        expires_at=utcnow() + timedelta(seconds=settings.SMS_CODE_EXPIRE_SECONDS),
     )
     db.add(record)
     db.commit()
@@ -457,7 +491,7 @@ def verify_mobile_code(
 ) -> ApiResponse[dict]:
     is_real_sms = _ensure_sms_configured()
     mobile = _normalize_mobile(req.mobile)
-    now = datetime.utcnow()
+    now = utcnow()
 
     record = (
         db.query(SmsVerifySession)
@@ -508,8 +542,8 @@ def verify_mobile_code(
             db.add(user)
             db.commit()
 
-    session = create_session(db, user)
-    set_session_cookie(response, session.id)
+    token = create_session(db, user)
+    set_session_cookie(response, token)
     credits = _get_user_credits(db, user.id)
     return ok(
         MeResponse(
@@ -518,7 +552,7 @@ def verify_mobile_code(
             is_admin=user.is_admin,
             credits=credits,
             mobile=user.mobile,
-        ).dict()
+        ).model_dump()
     )
 
 
@@ -544,7 +578,7 @@ def create_batch(
     if idem_key:
         existing = db.query(IdempotencyKey).filter(IdempotencyKey.key == idem_key).first()
         if existing:
-            cutoff = datetime.utcnow().timestamp() - settings.IDEMPOTENCY_WINDOW_SECONDS
+            cutoff = utcnow().timestamp() - settings.IDEMPOTENCY_WINDOW_SECONDS
             if existing.created_at.timestamp() > cutoff:
                 if existing.batch_id:
                     batch = db.get(Batch, existing.batch_id)
@@ -594,7 +628,6 @@ def create_batch(
         duration=req.duration,
         num_videos=req.num_videos,
         image_path=req.image_path,
-        total=req.num_videos,
     )
     db.add(batch)
     db.commit()
@@ -610,8 +643,8 @@ def create_batch(
     db.commit()
 
     print(f"[create_batch] creating {req.num_videos} tasks for batch_id={batch.id}")
-    for i in range(req.num_videos):
-        task = Task(
+    task_ids = Task.bulk_create(db, [
+        dict(
             batch_id=batch.id,
             user_id=user.id,
             prompt=prompt,
@@ -622,30 +655,32 @@ def create_batch(
             image_path=req.image_path,
             status=TaskStatus.queued,
         )
-        db.add(task)
-        db.flush()
-        print(f"[create_batch] task {i+1}/{req.num_videos} created: task_id={task.id}")
-        executor.enqueue_task(task.id)
+        for _ in range(req.num_videos)
+    ])
+    record_task_change(db, batch.id, None, TaskStatus.queued, count=req.num_videos)
     db.commit()
-    recompute_batch_counters(db, batch.id)
+    # 提交后再入队，避免 worker 读不到尚未提交的任务
+    for i, task_id in enumerate(task_ids):
+        print(f"[create_batch] task {i+1}/{req.num_videos} created: task_id={task_id}")
+        executor.enqueue_task(task_id, user.id)
 
     return ok({"batch_id": batch.id})
 
 
 @app.get("/api/batches")
-def list_batches(page: int = 1, page_size: int = 10, db: Session = Depends(get_db), user: User = Depends(get_current_user)) -> ApiResponse[dict]:
+def list_batches(page: int = 1, page_size: int = 10, db: Session = Depends(get_db), user: User = Depends(get_current_user)) -> ApiResponse[BatchPage]:
     q = db.query(Batch).filter(Batch.user_id == user.id, Batch.deleted_at.is_(None)).order_by(Batch.created_at.desc())
     total = q.count()
     page = max(1, page)
     page_size = max(1, min(50, page_size))
     items = q.offset((page - 1) * page_size).limit(page_size).all()
-    return ok({
-        "items": [BatchRead(**b.__dict__) for b in items],
-        "page": page,
-        "page_size": page_size,
-        "total": total,
-        "total_pages": (total + page_size - 1) // page_size,
-    })
+    return ok_json(BatchPageResponse, BatchPage(
+        items=[BatchRead.model_validate(b) for b in items],
+        page=page,
+        page_size=page_size,
+        total=total,
+        total_pages=(total + page_size - 1) // page_size,
+    ))
 
 
 @app.get("/api/batches/{batch_id}/tasks")
@@ -656,44 +691,27 @@ def list_tasks(batch_id: str, db: Session = Depends(get_db), user: User = Depend
     tasks = db.query(Task).filter(Task.batch_id == batch_id, Task.deleted_at.is_(None)).order_by(Task.created_at).all()
     # 历史清理：运行中但不会再进行的任务 → 置为失败；有结果但未完成 → 置为完成
     changed = False
-    now = datetime.utcnow()
+    now = utcnow()
     for t in tasks:
         if t.result_path and t.status != TaskStatus.completed:
+            record_task_transition(db, t, TaskStatus.completed)
             t.status = TaskStatus.completed
             db.add(t)
             changed = True
         # 简化标准：运行态超过30分钟视为失败（不引入settings）
         if t.status == TaskStatus.running and (now - t.updated_at).total_seconds() > 1800:
+            record_task_transition(db, t, TaskStatus.failed)
             t.status = TaskStatus.failed
             t.error_summary = t.error_summary or "运行超时"
             db.add(t)
             changed = True
             # 超时失败退款（避免重复退款）
             unit_cost = get_unit_cost(t.model, int(t.duration), t.size)
-            exists = (
-                db.query(CreditTransaction)
-                .filter(
-                    CreditTransaction.user_id == t.user_id,
-                    CreditTransaction.ref_task_id == t.id,
-                    CreditTransaction.delta > 0,
-                )
-                .first()
-            )
-            if not exists:
-                db.add(
-                    CreditTransaction(
-                        user_id=t.user_id,
-                        delta=unit_cost,
-                        reason=f"refund_task:{t.id}",
-                        ref_task_id=t.id,
-                        ref_batch_id=t.batch_id,
-                    )
-                )
+            refund_task_once(db, t, unit_cost)
     if changed:
         db.commit()
-        recompute_batch_counters(db, batch_id)
         tasks = db.query(Task).filter(Task.batch_id == batch_id, Task.deleted_at.is_(None)).order_by(Task.created_at).all()
-    return ok([TaskRead(**t.__dict__) for t in tasks])
+    return ok_json(TaskListResponse, [TaskRead.model_validate(t) for t in tasks])
 
 
 @app.post("/api/tasks/{task_id}/retry")
@@ -702,12 +720,12 @@ def retry_task(task_id: str, db: Session = Depends(get_db), user: User = Depends
     if not task or task.user_id != user.id:
         return fail("任务不存在")
     if task.status == TaskStatus.failed:
+        record_task_transition(db, task, TaskStatus.queued)
         task.status = TaskStatus.queued
         task.error_summary = None
         db.add(task)
         db.commit()
-        recompute_batch_counters(db, task.batch_id)
-        executor.enqueue_task(task.id)
+        executor.enqueue_task(task.id, task.user_id)
         return ok(None)
     return fail("仅失败任务可重试")
 
@@ -718,10 +736,10 @@ def cancel_task(task_id: str, db: Session = Depends(get_db), user: User = Depend
     if not task or task.user_id != user.id:
         return fail("任务不存在")
     if task.status in {TaskStatus.pending, TaskStatus.queued, TaskStatus.running}:
+        record_task_transition(db, task, TaskStatus.cancelled)
         task.status = TaskStatus.cancelled
         db.add(task)
         db.commit()
-        recompute_batch_counters(db, task.batch_id)
         return ok(None)
     return fail("任务无法取消")
 
@@ -731,24 +749,27 @@ def delete_task(task_id: str, db: Session = Depends(get_db), user: User = Depend
     task = db.get(Task, task_id)
     if not task or task.user_id != user.id:
         return fail("任务不存在")
-    task.deleted_at = datetime.utcnow()
     # 如果任务还在排队或待处理，标记为取消
-    if task.status in {TaskStatus.pending, TaskStatus.queued}:
-        task.status = TaskStatus.cancelled
+    new_status = TaskStatus.cancelled if task.status in {TaskStatus.pending, TaskStatus.queued} else task.status
+    record_task_change(
+        db, task.batch_id, task.status, new_status, was_deleted=task.deleted_at is not None, deleted=True,
+    )
+    task.deleted_at = utcnow()
+    task.status = new_status
     db.add(task)
     db.commit()
-    recompute_batch_counters(db, task.batch_id)
     return ok(None)
 
 
 @app.delete("/api/batches/{batch_id}")
 def delete_batch(batch_id: str, db: Session = Depends(get_db), user: User = Depends(get_current_user)) -> ApiResponse[None]:
-    batch = db.get(Batch, batch_id)
+    batch = db.get(Batch, batch_id, options=[selectinload(Batch.tasks)])
     if not batch or batch.user_id != user.id:
         return fail("批次不存在")
-    batch.deleted_at = datetime.utcnow()
+    now = utcnow()
+    batch.deleted_at = now
     for task in batch.tasks:
-        task.deleted_at = datetime.utcnow()
+        task.deleted_at = now
         # 如果任务还在排队或待处理，标记为取消
         if task.status in {TaskStatus.pending, TaskStatus.queued}:
             task.status = TaskStatus.cancelled
@@ -757,6 +778,33 @@ def delete_batch(batch_id: str, db: Session = Depends(get_db), user: User = Depe
     return ok(None)
 
 
+@app.post("/api/yunwu/callback")
+async def yunwu_callback(task_id: str, sig: str, request: Request):
+    """接收云雾任务状态回调，唤醒本进程中等待该任务的协程"""
+    if not settings.YUNWU_CALLBACK_SECRET or not hmac.compare_digest(sig, yunwu_callback_signature(task_id)):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="invalid signature")
+    try:
+        q = parse_task_payload(json_loads(await request.body()))
+    except Exception as e:
+        print(f"[yunwu_callback] invalid payload for task_id={task_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid payload")
+    delivered = deliver_yunwu_callback(task_id, q)
+    print(f"[yunwu_callback] task_id={task_id} status={q.status.value} delivered={delivered}")
+    return {"ok": True}
+
+
+# 打包下载远程视频时复用连接池（同一 CDN 主机只做一次 TCP/TLS 握手），5xx 时自动重试
+_download_session = requests.Session()
+_download_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=64,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+    ),
+)
+
+
 @app.get("/api/batches/{batch_id}/download")
 def download_zip(batch_id: str, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
     batch = db.get(Batch, batch_id)
@@ -787,9 +835,8 @@ def download_zip(batch_id: str, db: Session = Depends(get_db), user: User = Depe
                 if task.result_path.startswith("http://") or task.result_path.startswith("https://"):
                     # 远程 URL：下载到临时文件
                     try:
-                        import requests
                         print(f"[download_zip] 下载远程视频: {task.result_path}")
-                        resp = requests.get(task.result_path, timeout=60)
+                        resp = _download_session.get(task.result_path, timeout=60)
                         resp.raise_for_status()
                         
                         # 保存到临时文件
@@ -863,8 +910,13 @@ def get_order_status(
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user)
 ) -> ApiResponse[PaymentStatusResponse]:
-    order = db.query(RechargeOrder).filter(RechargeOrder.id == order_id).first()
-    if not order or order.user_id != user.id:
+    # 归属校验下推到数据库：非本人订单与不存在的订单同样查不到
+    order = (
+        db.query(RechargeOrder)
+        .filter(RechargeOrder.id == order_id, RechargeOrder.user_id == user.id)
+        .first()
+    )
+    if not order:
         return fail("订单不存在")
     
     # 主动查询状态（如果是 pending）
@@ -886,12 +938,38 @@ def get_credit_history(
     db: Session = Depends(get_db), 
     user: User = Depends(get_current_user)
 ) -> ApiResponse[dict]:
-    q = db.query(CreditTransaction).filter(CreditTransaction.user_id == user.id).order_by(CreditTransaction.created_at.desc())
-    total = q.count()
-    items = q.offset((page - 1) * page_size).limit(page_size).all()
+    # COUNT(*) OVER() 在同一次查询中返回总数，避免 count + 分页两次往返；
+    # 只取响应需要的列，不经过 ORM 实体实例化
+    rows = db.execute(
+        select(
+            CreditTransaction.id,
+            CreditTransaction.delta,
+            CreditTransaction.reason,
+            CreditTransaction.created_at,
+            CreditTransaction.ref_batch_id,
+            func.count().over().label("total"),
+        )
+        .where(CreditTransaction.user_id == user.id)
+        .order_by(CreditTransaction.created_at.desc())
+        .offset((page - 1) * page_size)
+        .limit(page_size)
+    ).all()
+    if rows:
+        total = rows[0].total
+    elif page > 1:
+        # 页码越界时窗口函数没有返回行，单独补一次计数
+        total = db.query(func.count(CreditTransaction.id)).filter(CreditTransaction.user_id == user.id).scalar()
+    else:
+        total = 0
     
     return ok({
-        "items": [CreditTransactionRead(**t.__dict__) for t in items],
+        "items": [
+            # 数据来自数据库且字段类型已确定，跳过 Pydantic 校验
+            CreditTransactionRead.model_construct(
+                id=r.id, delta=r.delta, reason=r.reason, created_at=r.created_at, ref_batch_id=r.ref_batch_id
+            )
+            for r in rows
+        ],
         "total": total,
         "page": page,
         "page_size": page_size
@@ -902,24 +980,56 @@ def get_credit_history(
 # Stripe 支付接口
 # -------------------------------------------------------------------------
 
+def _mark_order_paid(db: Session, order: RechargeOrder, reason: str, external_order_id: Optional[str] = None) -> bool:
+    """以 UPDATE ... WHERE status='pending' 原子地将订单置为已支付并入账积分。
+
+    返回 False 表示订单已被其他请求（Webhook / 轮询）处理，调用方不应再加积分。
+    """
+    values = {"status": "paid", "paid_at": utcnow()}
+    if external_order_id:
+        values["external_order_id"] = external_order_id
+    result = db.execute(
+        update(RechargeOrder)
+        .where(RechargeOrder.id == order.id, RechargeOrder.status == "pending")
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    db.add(CreditTransaction(user_id=order.user_id, delta=order.credits, reason=reason))
+    return True
+
+
 # Stripe 套餐配置（价格单位：美分）
 STRIPE_PACKAGES = [
     {"id": "pkg_100", "price_cents": 199, "credits": 100, "display": "$1.99 = 100 积分"},
     {"id": "pkg_500", "price_cents": 899, "credits": 500, "display": "$8.99 = 500 积分"},
     {"id": "pkg_1000", "price_cents": 1599, "credits": 1000, "display": "$15.99 = 1000 积分"},
 ]
+STRIPE_PACKAGES_BY_ID = {p["id"]: p for p in STRIPE_PACKAGES}
 
 
-@app.get("/api/stripe/config")
-def get_stripe_config(user: User = Depends(get_current_user)) -> ApiResponse[dict]:
-    """获取 Stripe 前端配置"""
-    if not settings.STRIPE_PUBLISHABLE_KEY:
-        return fail("Stripe 支付未配置")
-    
-    return ok({
+# Stripe 前端配置在进程生命周期内不变：启动时序列化一次并计算 ETag
+_STRIPE_CONFIG_BODY: Optional[bytes] = None
+_STRIPE_CONFIG_ETAG: Optional[str] = None
+if settings.STRIPE_PUBLISHABLE_KEY:
+    _STRIPE_CONFIG_BODY = ok({
         "publishable_key": settings.STRIPE_PUBLISHABLE_KEY,
         "packages": STRIPE_PACKAGES
-    })
+    }).model_dump_json().encode("utf-8")
+    _STRIPE_CONFIG_ETAG = f'"{hashlib.md5(_STRIPE_CONFIG_BODY).hexdigest()}"'
+
+
+@app.get("/api/stripe/config")
+def get_stripe_config(request: Request, user: User = Depends(get_current_user)):
+    """获取 Stripe 前端配置（支持 If-None-Match / 304）"""
+    if _STRIPE_CONFIG_BODY is None:
+        return fail("Stripe 支付未配置")
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _STRIPE_CONFIG_ETAG in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": _STRIPE_CONFIG_ETAG})
+    return Response(content=_STRIPE_CONFIG_BODY, media_type="application/json", headers={"ETag": _STRIPE_CONFIG_ETAG})
 
 
 @app.post("/api/stripe/create-checkout-session")
@@ -934,7 +1044,7 @@ def create_stripe_checkout(
         return fail("Stripe 支付未配置，请联系管理员")
     
     # 查找套餐
-    package = next((p for p in STRIPE_PACKAGES if p["id"] == package_id), None)
+    package = STRIPE_PACKAGES_BY_ID.get(package_id)
     if not package:
         return fail("无效的套餐")
     
@@ -996,8 +1106,84 @@ def create_stripe_checkout(
         return fail(f"创建支付会话失败: {str(e)}")
 
 
+def _process_stripe_event(event_id: str, event_type: str, obj: dict) -> bool:
+    """在线程池中执行：事件去重、订单加锁、状态更新与积分入账在同一事务内完成，最后统一提交。
+
+    返回 False 表示重复事件；任何异常都会整体回滚并抛出（事件未被记录，Stripe 重试时会重新处理）。
+    """
+    from .db import SessionLocal
+    with SessionLocal() as db:
+        try:
+            # 事件去重：同一 event_id 只处理一次（Stripe 重试/重复投递时直接返回）
+            if not insert_ignore(db, ProcessedStripeEvent, event_id=event_id, received_at=utcnow()):
+                db.rollback()
+                return False
+
+            # 处理 checkout.session.completed 事件
+            if event_type == "checkout.session.completed":
+                order_id = obj.get("client_reference_id") or obj.get("metadata", {}).get("order_id")
+                if order_id:
+                    # 行级锁（PostgreSQL/MySQL）串行化与支付状态轮询的并发更新；SQLite 下写事务本身已串行
+                    order = (
+                        db.query(RechargeOrder)
+                        .filter(RechargeOrder.id == order_id)
+                        .with_for_update()
+                        .first()
+                    )
+                    if order and _mark_order_paid(db, order, "stripe_recharge", external_order_id=obj.get("id")):
+                        logger.info("[Stripe Webhook] Payment successful: order=%s, credits=%s", order_id, order.credits)
+                    else:
+                        logger.info("[Stripe Webhook] Order not found or already processed: %s", order_id)
+                else:
+                    logger.warning("[Stripe Webhook] No order_id in session")
+
+            db.commit()
+            return True
+        except Exception:
+            db.rollback()
+            logger.exception("[Stripe Webhook] Failed to process event %s", event_id)
+            raise
+
+
+class _StripeEventRecency:
+    """记录每个 (对象ID, 事件类型) 已处理的最新 event.created，用于在内存中丢弃过期重投。
+
+    大小受限（按插入顺序淘汰），条目超过 24 小时视为过期。
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl_seconds: int = 86400) -> None:
+        self._seen: "OrderedDict[tuple, tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._ttl = ttl_seconds
+
+    def is_stale(self, key: tuple, created: int) -> bool:
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None:
+                return False
+            last_created, seen_at = entry
+            if time.time() - seen_at > self._ttl:
+                del self._seen[key]
+                return False
+            return created <= last_created
+
+    def record(self, key: tuple, created: int) -> None:
+        with self._lock:
+            entry = self._seen.pop(key, None)
+            if entry is not None:
+                created = max(created, entry[0])
+            self._seen[key] = (created, time.time())
+            while len(self._seen) > self._maxsize:
+                self._seen.popitem(last=False)
+
+
+_stripe_event_recency = _StripeEventRecency()
+STRIPE_EVENT_DEDUPE_SECONDS = 86400
+
+
 @app.post("/api/stripe/webhook")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
+async def stripe_webhook(request: Request):
     """接收 Stripe Webhook 回调"""
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
@@ -1016,36 +1202,41 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
     except stripe.error.SignatureVerificationError as e:
         print(f"[Stripe Webhook] Invalid signature: {e}")
         raise HTTPException(status_code=400, detail="Invalid signature")
-    
-    # 处理 checkout.session.completed 事件
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-        order_id = session.get("client_reference_id") or session.get("metadata", {}).get("order_id")
-        
-        if order_id:
-            order = db.query(RechargeOrder).filter(RechargeOrder.id == order_id).first()
-            if order and order.status == "pending":
-                # 更新订单状态
-                order.status = "paid"
-                order.external_order_id = session.get("id")
-                order.paid_at = datetime.utcnow()
-                db.add(order)
-                
-                # 添加积分
-                credit_tx = CreditTransaction(
-                    user_id=order.user_id,
-                    delta=order.credits,
-                    reason="stripe_recharge"
-                )
-                db.add(credit_tx)
-                db.commit()
-                
-                print(f"[Stripe Webhook] Payment successful: order={order_id}, credits={order.credits}")
-            else:
-                print(f"[Stripe Webhook] Order not found or already processed: {order_id}")
-        else:
-            print(f"[Stripe Webhook] No order_id in session")
-    
+
+    # 同一对象、同一类型的事件若不比已处理的更新，直接在内存中丢弃，不访问数据库
+    obj = event["data"]["object"]
+    recency_key = (obj.get("client_reference_id") or obj.get("id"), event["type"])
+    created = int(event.get("created") or 0)
+    if _stripe_event_recency.is_stale(recency_key, created):
+        print(f"[Stripe Webhook] Stale event ignored: {event['id']}")
+        return {"received": True}
+
+    # Redis 预检（可选）：重复投递直接返回，不访问数据库；Redis 不可用时回退到数据库去重
+    redis_key = f"stripe:evt:{event['id']}"
+    redis_client = get_async_redis()
+    if redis_client is not None:
+        try:
+            if not await redis_client.set(redis_key, 1, nx=True, ex=STRIPE_EVENT_DEDUPE_SECONDS):
+                print(f"[Stripe Webhook] Duplicate event ignored (redis): {event['id']}")
+                return {"received": True}
+        except Exception as e:
+            print(f"[Stripe Webhook] Redis dedupe unavailable: {e}")
+            redis_client = None
+
+    # 去重与入账同一事务完成后才返回 200；失败时不记录事件并返回 500，由 Stripe 重试
+    try:
+        claimed = await run_in_threadpool(_process_stripe_event, event["id"], event["type"], obj)
+    except Exception:
+        if redis_client is not None:
+            # 数据库未记录该事件，释放 Redis 标记以便 Stripe 重试时重新处理
+            try:
+                await redis_client.delete(redis_key)
+            except Exception:
+                pass
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Webhook processing failed")
+    _stripe_event_recency.record(recency_key, created)
+    if not claimed:
+        print(f"[Stripe Webhook] Duplicate event ignored: {event['id']}")
     return {"received": True}
 
 
@@ -1061,7 +1252,7 @@ def create_alipay_payment(
         return fail("Stripe 支付未配置，请联系管理员")
     
     # 查找套餐
-    package = next((p for p in STRIPE_PACKAGES if p["id"] == package_id), None)
+    package = STRIPE_PACKAGES_BY_ID.get(package_id)
     if not package:
         return fail("无效的套餐")
     
@@ -1083,11 +1274,16 @@ def create_alipay_payment(
         base_url = settings.BASE_URL
         return_url = f"{base_url}/?payment=success&order_id={order_id}"
         
-        # 创建 Stripe PaymentIntent
+        # 创建并确认 Stripe PaymentIntent（confirm=True 一次往返即可拿到支付宝重定向 URL）
         payment_intent = stripe.PaymentIntent.create(
             amount=package["price_cents"],
             currency="usd",
             payment_method_types=["alipay"],
+            payment_method_data={
+                "type": "alipay"
+            },
+            confirm=True,
+            return_url=return_url,
             metadata={
                 "order_id": order_id,
                 "user_id": str(user.id),
@@ -1100,21 +1296,12 @@ def create_alipay_payment(
         db.add(order)
         db.commit()
         
-        # 确认 PaymentIntent 以获取支付宝重定向 URL
-        confirmed_intent = stripe.PaymentIntent.confirm(
-            payment_intent.id,
-            payment_method_data={
-                "type": "alipay"
-            },
-            return_url=return_url
-        )
-        
         # 获取支付宝重定向 URL
         redirect_url = None
-        if confirmed_intent.next_action and confirmed_intent.next_action.type == "alipay_handle_redirect":
-            redirect_url = confirmed_intent.next_action.alipay_handle_redirect.url
-        elif confirmed_intent.next_action and confirmed_intent.next_action.type == "redirect_to_url":
-            redirect_url = confirmed_intent.next_action.redirect_to_url.url
+        if payment_intent.next_action and payment_intent.next_action.type == "alipay_handle_redirect":
+            redirect_url = payment_intent.next_action.alipay_handle_redirect.url
+        elif payment_intent.next_action and payment_intent.next_action.type == "redirect_to_url":
+            redirect_url = payment_intent.next_action.redirect_to_url.url
         
         if not redirect_url:
             return fail("无法获取支付宝支付链接")
@@ -1142,6 +1329,7 @@ WECHAT_PACKAGES = [
     {"id": "pkg_500", "price_cny_cents": 6400, "credits": 500, "display": "¥64 = 500 积分"},
     {"id": "pkg_1000", "price_cny_cents": 11500, "credits": 1000, "display": "¥115 = 1000 积分"},
 ]
+WECHAT_PACKAGES_BY_ID = {p["id"]: p for p in WECHAT_PACKAGES}
 
 
 @app.post("/api/stripe/create-wechat-payment")
@@ -1165,7 +1353,7 @@ def create_wechat_payment(
         credits = custom_amount * 10  # 1元=10积分
     else:
         # 预设套餐模式
-        package = next((p for p in WECHAT_PACKAGES if p["id"] == package_id), None)
+        package = WECHAT_PACKAGES_BY_ID.get(package_id)
         if not package:
             return fail("无效的套餐")
         price_cny_cents = package["price_cny_cents"]
@@ -1189,11 +1377,21 @@ def create_wechat_payment(
         base_url = settings.BASE_URL
         return_url = f"{base_url}/?payment=success&order_id={order_id}"
         
-        # 创建 Stripe PaymentIntent (微信支付，使用 CNY)
+        # 创建并确认 Stripe PaymentIntent (微信支付，使用 CNY；confirm=True 一次往返即可拿到二维码)
         payment_intent = stripe.PaymentIntent.create(
             amount=price_cny_cents,
             currency="cny",  # 微信支付必须使用 CNY 或 HKD
             payment_method_types=["wechat_pay"],
+            payment_method_data={
+                "type": "wechat_pay"
+            },
+            payment_method_options={
+                "wechat_pay": {
+                    "client": "web"  # 指定为 web 端
+                }
+            },
+            confirm=True,
+            return_url=return_url,
             metadata={
                 "order_id": order_id,
                 "user_id": str(user.id),
@@ -1206,27 +1404,13 @@ def create_wechat_payment(
         db.add(order)
         db.commit()
         
-        # 确认 PaymentIntent 以获取微信支付二维码
-        confirmed_intent = stripe.PaymentIntent.confirm(
-            payment_intent.id,
-            payment_method_data={
-                "type": "wechat_pay"
-            },
-            payment_method_options={
-                "wechat_pay": {
-                    "client": "web"  # 指定为 web 端
-                }
-            },
-            return_url=return_url
-        )
-        
         # 获取微信支付二维码 URL
         qr_code_url = None
-        if confirmed_intent.next_action:
-            if confirmed_intent.next_action.type == "wechat_pay_display_qr_code":
-                qr_code_url = confirmed_intent.next_action.wechat_pay_display_qr_code.data
-            elif confirmed_intent.next_action.type == "redirect_to_url":
-                qr_code_url = confirmed_intent.next_action.redirect_to_url.url
+        if payment_intent.next_action:
+            if payment_intent.next_action.type == "wechat_pay_display_qr_code":
+                qr_code_url = payment_intent.next_action.wechat_pay_display_qr_code.data
+            elif payment_intent.next_action.type == "redirect_to_url":
+                qr_code_url = payment_intent.next_action.redirect_to_url.url
         
         if not qr_code_url:
             return fail("无法获取微信支付二维码")
@@ -1254,8 +1438,13 @@ def get_stripe_payment_status(
     user: User = Depends(get_current_user)
 ) -> ApiResponse[dict]:
     """查询 Stripe 支付状态（用于前端轮询）"""
-    order = db.query(RechargeOrder).filter(RechargeOrder.id == order_id).first()
-    if not order or order.user_id != user.id:
+    # 归属校验下推到数据库：非本人订单与不存在的订单同样查不到
+    order = (
+        db.query(RechargeOrder)
+        .filter(RechargeOrder.id == order_id, RechargeOrder.user_id == user.id)
+        .first()
+    )
+    if not order:
         return fail("订单不存在")
     
     # 如果订单已完成，直接返回
@@ -1273,24 +1462,11 @@ def get_stripe_payment_status(
                 payment_intent = stripe.PaymentIntent.retrieve(order.external_order_id)
                 
                 if payment_intent.status == "succeeded":
-                    # 更新订单状态
-                    order.status = "paid"
-                    order.paid_at = datetime.utcnow()
-                    db.add(order)
-                    
-                    # 根据支付方式确定 reason
+                    # 根据支付方式确定 reason；若 Webhook 已先行入账则不再重复加积分
                     reason = f"{order.payment_method}_recharge"
-                    
-                    # 添加积分
-                    credit_tx = CreditTransaction(
-                        user_id=order.user_id,
-                        delta=order.credits,
-                        reason=reason
-                    )
-                    db.add(credit_tx)
-                    db.commit()
-                    
-                    print(f"[Stripe] Payment successful: order={order_id}, method={order.payment_method}, credits={order.credits}")
+                    if _mark_order_paid(db, order, reason):
+                        db.commit()
+                        print(f"[Stripe] Payment successful: order={order_id}, method={order.payment_method}, credits={order.credits}")
                     return ok({
                         "status": "paid",
                         "credits": order.credits
@@ -1309,10 +1485,8 @@ def get_stripe_payment_status(
     return ok({"status": order.status})
 
 
-# Mock 支付页面
-@app.get("/mock-pay.html", response_class=HTMLResponse)
-def mock_pay_page(order_id: str, amount: float, credits: int):
-    html_content = f"""
+# Mock 支付页面（模板在模块加载时切分为字节片段，请求时仅拼接占位符的值）
+_MOCK_PAY_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -1320,33 +1494,33 @@ def mock_pay_page(order_id: str, amount: float, credits: int):
         <meta charset="utf-8">
         <meta name="viewport" content="width=device-width, initial-scale=1">
         <style>
-            body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; background: #f0f2f5; margin: 0; }}
-            .card {{ background: white; padding: 2.5rem; border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); text-align: center; max-width: 400px; width: 90%; }}
-            h1 {{ color: #1f1f1f; font-size: 20px; margin-bottom: 1.5rem; font-weight: 600; }}
-            .amount {{ font-size: 36px; color: #1677ff; font-weight: bold; margin: 0.5rem 0; display: flex; align-items: baseline; justify-content: center; }}
-            .amount small {{ font-size: 18px; margin-right: 4px; font-weight: normal; }}
-            .info {{ color: #666; font-size: 14px; margin-bottom: 0.5rem; }}
-            .qr-container {{ margin: 1.5rem 0; background: #f8f9fa; padding: 1rem; border-radius: 8px; display: inline-block; }}
-            .qr-code {{ width: 180px; height: 180px; background-color: #fff; padding: 10px; border-radius: 4px; }}
-            .btn-group {{ display: flex; flex-direction: column; gap: 10px; margin-top: 1.5rem; }}
-            button {{ background: #1677ff; color: white; border: none; padding: 12px 20px; border-radius: 6px; cursor: pointer; font-size: 16px; width: 100%; transition: all 0.2s; font-weight: 500; }}
-            button:hover {{ background: #4096ff; transform: translateY(-1px); box-shadow: 0 2px 5px rgba(22,119,255,0.2); }}
-            button:active {{ transform: translateY(0); }}
-            .cancel {{ background: #f5f5f5; color: #666; }}
-            .cancel:hover {{ background: #e0e0e0; color: #333; box-shadow: none; }}
-            .divider {{ height: 1px; background: #eee; margin: 1.5rem 0; }}
+            body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; background: #f0f2f5; margin: 0; }
+            .card { background: white; padding: 2.5rem; border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); text-align: center; max-width: 400px; width: 90%; }
+            h1 { color: #1f1f1f; font-size: 20px; margin-bottom: 1.5rem; font-weight: 600; }
+            .amount { font-size: 36px; color: #1677ff; font-weight: bold; margin: 0.5rem 0; display: flex; align-items: baseline; justify-content: center; }
+            .amount small { font-size: 18px; margin-right: 4px; font-weight: normal; }
+            .info { color: #666; font-size: 14px; margin-bottom: 0.5rem; }
+            .qr-container { margin: 1.5rem 0; background: #f8f9fa; padding: 1rem; border-radius: 8px; display: inline-block; }
+            .qr-code { width: 180px; height: 180px; background-color: #fff; padding: 10px; border-radius: 4px; }
+            .btn-group { display: flex; flex-direction: column; gap: 10px; margin-top: 1.5rem; }
+            button { background: #1677ff; color: white; border: none; padding: 12px 20px; border-radius: 6px; cursor: pointer; font-size: 16px; width: 100%; transition: all 0.2s; font-weight: 500; }
+            button:hover { background: #4096ff; transform: translateY(-1px); box-shadow: 0 2px 5px rgba(22,119,255,0.2); }
+            button:active { transform: translateY(0); }
+            .cancel { background: #f5f5f5; color: #666; }
+            .cancel:hover { background: #e0e0e0; color: #333; box-shadow: none; }
+            .divider { height: 1px; background: #eee; margin: 1.5rem 0; }
         </style>
     </head>
     <body>
         <div class="card">
             <h1>模拟支付收银台</h1>
-            <div class="info">订单号: {order_id}</div>
-            <div class="amount"><small>¥</small>{amount}</div>
-            <div class="info">支付后将获得 <span style="color: #1677ff; font-weight: bold;">{credits}</span> 积分</div>
+            <div class="info">订单号: ${order_id}</div>
+            <div class="amount"><small>¥</small>${amount}</div>
+            <div class="info">支付后将获得 <span style="color: #1677ff; font-weight: bold;">${credits}</span> 积分</div>
             
             <div class="qr-container">
                 <!-- 使用 API 生成简单的二维码，或者使用静态占位图 -->
-                <img src="https://api.qrserver.com/v1/create-qr-code/?size=180x180&data=MOCK_PAYMENT_{order_id}" class="qr-code" alt="Mock QR Code" />
+                <img src="https://api.qrserver.com/v1/create-qr-code/?size=180x180&data=MOCK_PAYMENT_${order_id}" class="qr-code" alt="Mock QR Code" />
                 <div style="font-size: 12px; color: #999; margin-top: 8px;">请使用手机扫码支付 (模拟)</div>
             </div>
 
@@ -1356,38 +1530,53 @@ def mock_pay_page(order_id: str, amount: float, credits: int):
             </div>
         </div>
         <script>
-            async function confirmPay() {{
+            async function confirmPay() {
                 const btn = document.querySelector('button');
                 btn.disabled = true;
                 btn.textContent = '处理中...';
-                try {{
-                    const res = await fetch('/api/mock/pay/{order_id}', {{ method: 'POST' }});
+                try {
+                    const res = await fetch('/api/mock/pay/${order_id}', { method: 'POST' });
                     const data = await res.json();
-                    if (data.ok) {{
+                    if (data.ok) {
                         // 支付成功后，尝试通知父窗口刷新（如果是弹窗）
-                        try {{
-                            if (window.opener && !window.opener.closed) {{
-                                window.opener.postMessage({{ type: 'PAYMENT_SUCCESS', orderId: '{order_id}' }}, '*');
-                            }}
-                        }} catch (e) {{ console.error(e); }}
+                        try {
+                            if (window.opener && !window.opener.closed) {
+                                window.opener.postMessage({ type: 'PAYMENT_SUCCESS', orderId: '${order_id}' }, '*');
+                            }
+                        } catch (e) { console.error(e); }
                         
                         alert('支付成功！请返回原窗口查看。');
                         window.close();
-                    }} else {{
+                    } else {
                         alert('支付失败: ' + (data.error?.message || '未知错误'));
-                    }}
-                }} catch (e) {{
+                    }
+                } catch (e) {
                     alert('网络错误');
-                }} finally {{
+                } finally {
                     btn.disabled = false;
                     btn.textContent = '确认支付 (模拟成功)';
-                }}
-            }}
+                }
+            }
         </script>
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+# 偶数下标为静态 HTML 字节，奇数下标为占位符名
+_MOCK_PAY_SEGMENTS = tuple(
+    part.encode("utf-8") if i % 2 == 0 else part
+    for i, part in enumerate(re.split(r"\$\{(\w+)\}", _MOCK_PAY_HTML))
+)
+
+
+@app.get("/mock-pay.html", response_class=HTMLResponse)
+def mock_pay_page(order_id: str, amount: float, credits: int):
+    values = {
+        "order_id": order_id.encode("utf-8"),
+        "amount": str(amount).encode("utf-8"),
+        "credits": str(credits).encode("utf-8"),
+    }
+    body = b"".join(seg if i % 2 == 0 else values[seg] for i, seg in enumerate(_MOCK_PAY_SEGMENTS))
+    return HTMLResponse(content=body)
 
 @app.post("/api/mock/pay/{order_id}")
 def mock_pay_confirm(order_id: str, db: Session = Depends(get_db)):
@@ -1399,12 +1588,19 @@ def mock_pay_confirm(order_id: str, db: Session = Depends(get_db)):
 # -------------------------------------------------------------------------
 # 静态文件缓存控制中间件
 # -------------------------------------------------------------------------
+_NOCACHE_SUFFIXES = ('.js', '.css', '.html')
+_CACHE_EXEMPT_PREFIXES = ('/api/', '/uploads/')
+
+
 @app.middleware("http")
 async def add_cache_control_headers(request: Request, call_next):
     response = await call_next(request)
-    # 对 JS、CSS 和 HTML 文件禁用缓存（开发环境）
     path = request.url.path
-    if path.endswith(('.js', '.css', '.html')) or path == '/' or path == '':
+    # API 与上传文件无需处理，直接返回
+    if path.startswith(_CACHE_EXEMPT_PREFIXES):
+        return response
+    # 对 JS、CSS 和 HTML 文件禁用缓存（开发环境）
+    if path.endswith(_NOCACHE_SUFFIXES) or path == '/' or path == '':
         response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
         response.headers["Pragma"] = "no-cache"
         response.headers["Expires"] = "0"
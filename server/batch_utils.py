@@ -1,30 +1,179 @@
 from __future__ import annotations
 
-from sqlalchemy import func
+from typing import Optional
+
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session
 
-from .models import Batch, Task, TaskStatus
+from .db import insert_ignore
+from .models import Batch, CreditTransaction, Task, TaskStatus
 
 
-def recompute_batch_counters(db: Session, batch_id: str) -> None:
-    counts = (
-        db.query(Task.status, func.count(Task.id))
-        .filter(Task.batch_id == batch_id, Task.deleted_at.is_(None))
-        .group_by(Task.status)
-        .all()
+def _count_tasks(*statuses: TaskStatus):
+    # 关联子查询：按 (batch_id, status, deleted_at) 索引计数
+    return (
+        select(func.count(Task.id))
+        .where(Task.batch_id == Batch.id, Task.deleted_at.is_(None), Task.status.in_(statuses))
+        .scalar_subquery()
     )
-    status_to_count = {status: cnt for status, cnt in counts}
 
-    def c(status: TaskStatus) -> int:
-        return int(status_to_count.get(status, 0))
 
-    batch = db.get(Batch, batch_id)
-    if not batch:
-        return
-    batch.completed = c(TaskStatus.completed)
-    batch.failed = c(TaskStatus.failed)
-    batch.running = c(TaskStatus.running)
-    batch.queued = c(TaskStatus.queued) + c(TaskStatus.pending)
-    batch.total = batch.completed + batch.failed + batch.running + batch.queued
-    db.add(batch)
+def recompute_batch_counters(db: Session, batch_id: Optional[str] = None) -> None:
+    """全量重算计数器，仅作启动时对账；batch_id 为空时重算全部未删除批次。
+
+    日常状态变化由触发器或 record_task_change 增量维护，不再逐任务调用。
+    """
+    # 单条 UPDATE 完成聚合与回写（兼容不支持 UPDATE ... FROM 的旧版 SQLite）
+    stmt = update(Batch)
+    if batch_id is not None:
+        stmt = stmt.where(Batch.id == batch_id)
+    else:
+        stmt = stmt.where(Batch.deleted_at.is_(None))
+    db.execute(
+        stmt
+        .values(
+            completed=_count_tasks(TaskStatus.completed),
+            failed=_count_tasks(TaskStatus.failed),
+            running=_count_tasks(TaskStatus.running),
+            queued=_count_tasks(TaskStatus.queued, TaskStatus.pending),
+            total=_count_tasks(TaskStatus.completed, TaskStatus.failed, TaskStatus.running, TaskStatus.queued, TaskStatus.pending),
+        )
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
+
+
+def _inc_batch(db: Session, batch_id: str, **deltas: int) -> None:
+    # 单条原子 UPDATE：completed = completed + 1 等，不扫描批次下的任务
+    values = {getattr(Batch, column): getattr(Batch, column) + delta for column, delta in deltas.items() if delta}
+    if not values:
+        return
+    db.execute(
+        update(Batch)
+        .where(Batch.id == batch_id)
+        .values(values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def has_counter_triggers(db: Session) -> bool:
+    return db.get_bind().dialect.name in _TRIGGER_DIALECTS
+
+
+def record_task_change(
+    db: Session,
+    batch_id: str,
+    old_status: Optional[TaskStatus],
+    new_status: TaskStatus,
+    *,
+    count: int = 1,
+    was_deleted: bool = False,
+    deleted: bool = False,
+) -> None:
+    """任务状态变化后增量调整批次计数：old_status 为 None 表示新建，已软删除的任务不计入。
+
+    已安装触发器的数据库由触发器在同一语句内维护，这里直接返回；调用方负责提交。
+    """
+    if has_counter_triggers(db):
+        return
+    old_value = None if old_status is None or was_deleted else old_status.value
+    new_value = None if deleted else new_status.value
+    deltas = {}
+    for column, statuses in _COUNTER_STATUSES.items():
+        deltas[column] = ((new_value in statuses) - (old_value in statuses)) * count
+    _inc_batch(db, batch_id, **deltas)
+
+
+def record_task_transition(db: Session, task: Task, new_status: TaskStatus) -> None:
+    # 在修改 task.status 之前调用；软删除状态不变
+    deleted = task.deleted_at is not None
+    record_task_change(db, task.batch_id, task.status, new_status, was_deleted=deleted, deleted=deleted)
+
+
+def refund_task_once(db: Session, task: Task, amount: int) -> bool:
+    """失败退款；由 uq_credit_refund_per_task 唯一索引保证幂等，已退过时不插入并返回 False"""
+    return insert_ignore(
+        db,
+        CreditTransaction,
+        user_id=task.user_id,
+        delta=amount,
+        reason=f"refund_task:{task.id}",
+        ref_task_id=task.id,
+        ref_batch_id=task.batch_id,
+    )
+
+
+# 任务计数器由数据库触发器增量维护：tasks 插入、状态或 deleted_at 变化时，同一语句内更新所属批次
+_COUNTER_STATUSES = {
+    "completed": ("completed",),
+    "failed": ("failed",),
+    "running": ("running",),
+    "queued": ("queued", "pending"),
+    "total": ("completed", "failed", "running", "queued", "pending"),
+}
+
+_TRIGGER_DIALECTS = {"sqlite", "postgresql"}
+
+
+def _flag(row: str, statuses: tuple) -> str:
+    in_list = ", ".join(f"'{s}'" for s in statuses)
+    return f"(CASE WHEN {row}.status IN ({in_list}) AND {row}.deleted_at IS NULL THEN 1 ELSE 0 END)"
+
+
+def _counter_set_clause(with_old: bool, now_sql: str) -> str:
+    parts = []
+    for column, statuses in _COUNTER_STATUSES.items():
+        expr = f"{column} + {_flag('NEW', statuses)}"
+        if with_old:
+            expr += f" - {_flag('OLD', statuses)}"
+        parts.append(f"{column} = {expr}")
+    parts.append(f"updated_at = {now_sql}")
+    return ", ".join(parts)
+
+
+def install_batch_counter_triggers(engine) -> None:
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        now_sql = "CURRENT_TIMESTAMP"
+        statements = [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_batch_counters_insert AFTER INSERT ON tasks
+            BEGIN
+                UPDATE batches SET {_counter_set_clause(False, now_sql)} WHERE id = NEW.batch_id;
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_batch_counters_update AFTER UPDATE OF status, deleted_at ON tasks
+            WHEN OLD.status IS NOT NEW.status OR OLD.deleted_at IS NOT NEW.deleted_at
+            BEGIN
+                UPDATE batches SET {_counter_set_clause(True, now_sql)} WHERE id = NEW.batch_id;
+            END
+            """,
+        ]
+    elif dialect == "postgresql":
+        now_sql = "(now() AT TIME ZONE 'utc')"
+        statements = [
+            f"""
+            CREATE OR REPLACE FUNCTION tasks_batch_counters() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE batches SET {_counter_set_clause(False, now_sql)} WHERE id = NEW.batch_id;
+                ELSIF OLD.status IS DISTINCT FROM NEW.status OR OLD.deleted_at IS DISTINCT FROM NEW.deleted_at THEN
+                    UPDATE batches SET {_counter_set_clause(True, now_sql)} WHERE id = NEW.batch_id;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS trg_tasks_batch_counters ON tasks",
+            """
+            CREATE TRIGGER trg_tasks_batch_counters AFTER INSERT OR UPDATE OF status, deleted_at ON tasks
+            FOR EACH ROW EXECUTE FUNCTION tasks_batch_counters()
+            """,
+        ]
+    else:
+        # 其他数据库不安装触发器，计数由 record_task_change 增量维护
+        return
+    with engine.begin() as conn:
+        for stmt in statements:
+            conn.exec_driver_sql(stmt)
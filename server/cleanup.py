@@ -3,28 +3,80 @@ from __future__ import annotations
 import asyncio
 import os
 import time
-from pathlib import Path
+from datetime import timedelta
+from typing import Iterator, List
 
+from .db import SessionLocal
+from .models import ProcessedStripeEvent, UserSession, utcnow
 from .settings import settings
 
 
+STRIPE_EVENT_TTL = timedelta(hours=24)
+UNLINK_CONCURRENCY = 32
+
+
+def _purge_processed_stripe_events() -> None:
+    cutoff = utcnow() - STRIPE_EVENT_TTL
+    with SessionLocal() as db:
+        db.query(ProcessedStripeEvent).filter(ProcessedStripeEvent.received_at < cutoff).delete(synchronize_session=False)
+        db.commit()
+
+
+def _purge_expired_sessions() -> None:
+    with SessionLocal() as db:
+        db.query(UserSession).filter(UserSession.expires_at < utcnow()).delete(synchronize_session=False)
+        db.commit()
+
+
+def _iter_files(path: str) -> Iterator[os.DirEntry]:
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+            else:
+                yield entry
+
+
+def _collect_expired(base: str, now: float, ttl_seconds: int) -> List[str]:
+    os.makedirs(base, exist_ok=True)
+    expired: List[str] = []
+    for entry in _iter_files(base):
+        try:
+            # DirEntry.stat 复用 scandir 返回的信息，避免再构造 Path 并重复 stat
+            if now - entry.stat(follow_symlinks=False).st_mtime > ttl_seconds:
+                expired.append(entry.path)
+        except Exception:
+            pass
+    return expired
+
+
+async def _remove_files(paths: List[str]) -> None:
+    # 并发删除（网络文件系统上每次 unlink 都是一次往返），用信号量限制并发线程数
+    sem = asyncio.Semaphore(UNLINK_CONCURRENCY)
+
+    async def _rm(path: str) -> None:
+        async with sem:
+            await asyncio.to_thread(os.unlink, path)
+
+    await asyncio.gather(*(_rm(p) for p in paths), return_exceptions=True)
+
+
 async def cleanup_loop() -> None:
     ttl_seconds = settings.LOCAL_FILE_TTL_DAYS * 24 * 3600
-    upload_dir = Path(settings.UPLOAD_DIR)
-    results_dir = Path(settings.RESULTS_BASE_DIR)
     while True:
         now = time.time()
-        for base in (upload_dir, results_dir):
+        for base in (settings.UPLOAD_DIR, settings.RESULTS_BASE_DIR):
             try:
-                base.mkdir(parents=True, exist_ok=True)
-                for root, _, files in os.walk(base):
-                    for name in files:
-                        fpath = Path(root) / name
-                        try:
-                            if now - fpath.stat().st_mtime > ttl_seconds:
-                                fpath.unlink(missing_ok=True)
-                        except Exception:
-                            pass
+                expired = await asyncio.to_thread(_collect_expired, base, now, ttl_seconds)
+                await _remove_files(expired)
             except Exception:
                 pass
+        try:
+            await asyncio.to_thread(_purge_processed_stripe_events)
+        except Exception:
+            pass
+        try:
+            await asyncio.to_thread(_purge_expired_sessions)
+        except Exception:
+            pass
         await asyncio.sleep(3600)
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, Optional
+
+from .redis_client import get_async_redis
+from .settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+# 槽位租约时长：任务不续租，需覆盖单个任务的最长执行时间；进程崩溃未释放时，槽位最多泄漏这么久
+SLOT_LEASE_SECONDS = settings.MAX_POLL_SECONDS * 2 + 300
+
+LOCAL_SLOT = "local"
+
+_GLOBAL_KEY = "conc:global"
+
+# 槽位为有序集合中的成员（分值为租约到期时间）：计数前先剔除已过期租约，
+# 崩溃进程留下的槽位到期自动回收，不会因持续有流量而被无限续期。
+# 原子地同时占用全局与用户槽位，任一超限则都不占用。
+_ACQUIRE_LUA = """
+-- 旧版本以字符串计数器保存槽位，遇到时直接替换为有序集合
+for _, key in ipairs(KEYS) do
+    if redis.call('TYPE', key).ok == 'string' then
+        redis.call('DEL', key)
+    end
+end
+local now = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) or redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[2]) then
+    return 0
+end
+local deadline = now + tonumber(ARGV[4])
+redis.call('ZADD', KEYS[1], deadline, ARGV[5])
+redis.call('ZADD', KEYS[2], deadline, ARGV[5])
+-- 键的过期时间只用于回收空闲键；成员各自带到期时间，键总比其中最晚的租约活得久
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+
+def _user_key(user_id: int) -> str:
+    return f"conc:user:{user_id}"
+
+
+class ConcurrencyLimiter:
+    """全局/每用户并发槽位。
+
+    配置了 Redis 时槽位为 Redis 中带到期时间的租约（多 worker/多副本共享 GLOBAL_CONCURRENCY 上限），
+    否则或 Redis 不可用时退化为进程内计数。acquire 返回槽位标识（Redis 租约 ID 或 LOCAL_SLOT），release 时原样传回。
+    """
+
+    def __init__(self) -> None:
+        self.global_running: int = 0
+        self.user_running: Dict[int, int] = defaultdict(int)
+        self._acquire_script = None
+
+    async def acquire(self, user_id: int) -> Optional[str]:
+        redis_client = get_async_redis()
+        if redis_client is not None:
+            try:
+                if self._acquire_script is None:
+                    self._acquire_script = redis_client.register_script(_ACQUIRE_LUA)
+                lease_id = uuid.uuid4().hex
+                granted = await self._acquire_script(
+                    keys=[_GLOBAL_KEY, _user_key(user_id)],
+                    args=[
+                        settings.GLOBAL_CONCURRENCY,
+                        settings.PER_USER_CONCURRENCY,
+                        time.time(),
+                        SLOT_LEASE_SECONDS,
+                        lease_id,
+                    ],
+                )
+                return lease_id if granted else None
+            except Exception as e:
+                logger.warning("[concurrency] redis unavailable, using local counters: %s", e)
+
+        if self.global_running >= settings.GLOBAL_CONCURRENCY:
+            return None
+        if self.user_running[user_id] >= settings.PER_USER_CONCURRENCY:
+            return None
+        self.global_running += 1
+        self.user_running[user_id] += 1
+        return LOCAL_SLOT
+
+    async def release(self, user_id: int, slot: str) -> None:
+        if slot != LOCAL_SLOT:
+            redis_client = get_async_redis()
+            try:
+                pipe = redis_client.pipeline(transaction=True)
+                pipe.zrem(_GLOBAL_KEY, slot)
+                pipe.zrem(_user_key(user_id), slot)
+                await pipe.execute()
+            except Exception as e:
+                # 释放失败时依赖租约到期回收槽位
+                logger.warning("[concurrency] redis release failed: %s", e)
+            return
+
+        self.global_running -= 1
+        self.user_running[user_id] -= 1
+        if self.user_running[user_id] <= 0:
+            self.user_running.pop(user_id, None)
@@ -2,37 +2,33 @@ from __future__ import annotations
 
 import base64
 import os
-from typing import Optional
 
 from cryptography.fernet import Fernet
 
 from .settings import settings
 
 
-_fernet_instance: Optional[Fernet] = None
-
-
-def _get_fernet() -> Fernet:
-    global _fernet_instance
-    if _fernet_instance is not None:
-        return _fernet_instance
-
+def _build_fernet() -> Fernet:
     secret = settings.CRYPTO_SECRET
     if secret:
         key = secret.encode("utf-8")
     else:
         key = base64.urlsafe_b64encode(os.urandom(32))
-    _fernet_instance = Fernet(key)
-    return _fernet_instance
+    try:
+        return Fernet(key)
+    except ValueError as exc:
+        raise RuntimeError("CRYPTO_SECRET 无效：需要 32 字节 urlsafe base64 编码的 Fernet 密钥") from exc
+
+
+# 进程启动时构建一次，加解密直接绑定实例方法
+_FERNET = _build_fernet()
+_encrypt = _FERNET.encrypt
+_decrypt = _FERNET.decrypt
 
 
 def encrypt_text(plaintext: str) -> str:
-    f = _get_fernet()
-    token = f.encrypt(plaintext.encode("utf-8"))
-    return token.decode("utf-8")
+    return _encrypt(plaintext.encode("utf-8")).decode("utf-8")
 
 
 def decrypt_text(ciphertext: str) -> str:
-    f = _get_fernet()
-    plain = f.decrypt(ciphertext.encode("utf-8"))
-    return plain.decode("utf-8")
+    return _decrypt(ciphertext.encode("utf-8")).decode("utf-8")
@@ -4,7 +4,8 @@ from contextlib import contextmanager
 from typing import Generator
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 from sqlalchemy.pool import StaticPool
 
@@ -15,6 +16,8 @@ SQLALCHEMY_DATABASE_URL = os.environ.get(
     "DATABASE_URL", f"sqlite:///{os.path.join(settings.BASE_DIR, 'app.db')}"
 )
 
+# 所有引擎共用 SQLAlchemy 的 LRU 编译缓存（按语句结构缓存，与参数值无关）；
+# 默认 500 条在路由较多时会互相挤出，调大后热点语句不再重复编译
 # check_same_thread=False is required for SQLite with FastAPI (multithreaded server)
 if SQLALCHEMY_DATABASE_URL.startswith("sqlite") and ":memory:" in SQLALCHEMY_DATABASE_URL:
     # Share the same in-memory DB across the app for tests
@@ -22,13 +25,36 @@ if SQLALCHEMY_DATABASE_URL.startswith("sqlite") and ":memory:" in SQLALCHEMY_DAT
         SQLALCHEMY_DATABASE_URL,
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+    )
+elif SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
     )
 else:
+    # 服务端数据库：可调连接池，pre_ping 剔除已断开的连接，定期回收避免长连接被服务端关闭
     engine = create_engine(
         SQLALCHEMY_DATABASE_URL,
-        connect_args={"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {},
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
     )
 
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite") and ":memory:" not in SQLALCHEMY_DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, _connection_record) -> None:
+        # WAL 允许写入时并发读取；NORMAL 在 WAL 下仍保证一致性，且每次提交少一次 fsync
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -54,9 +80,25 @@ def session_scope() -> Generator[Session, None, None]:
         session.close()
 
 
+def insert_ignore(db: Session, model, **values) -> bool:
+    """INSERT ... ON CONFLICT DO NOTHING; returns True if a new row was inserted."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        stmt = sqlite.insert(model).values(**values).on_conflict_do_nothing()
+    elif dialect == "postgresql":
+        stmt = postgresql.insert(model).values(**values).on_conflict_do_nothing()
+    else:
+        stmt = model.__table__.insert().values(**values).prefix_with("IGNORE")
+    result = db.execute(stmt)
+    return result.rowcount == 1
+
+
 def init_db() -> None:
     # Import models to register metadata
     from . import models  # noqa: F401
 
     Base.metadata.create_all(bind=engine)
 
+    from .batch_utils import install_batch_counter_triggers
+    install_batch_counter_triggers(engine)
+
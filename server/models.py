@@ -1,30 +1,52 @@
 from __future__ import annotations
 
 import enum
-import secrets
+import os
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from typing import List, Optional
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     CheckConstraint,
     Column,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
+    SmallInteger,
     String,
     Text,
     UniqueConstraint,
+    insert,
+    text,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 
 from .db import Base
 
 
 def utcnow() -> datetime:
-    return datetime.utcnow()
+    """当前 UTC 时间（naive，与 DateTime 列一致）；datetime.utcnow() 在 3.12 起已弃用"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def uuid7() -> uuid.UUID:
+    """Time-ordered UUID (RFC 9562 v7): 48-bit unix ms timestamp + 74 random bits."""
+    value = ((time.time_ns() // 1_000_000) & ((1 << 48) - 1)) << 80
+    value |= int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # RFC 4122 variant
+    return uuid.UUID(int=value)
+
+
+def uuid7_str() -> str:
+    return str(uuid7())
 
 
 class TaskStatus(str, enum.Enum):
@@ -50,17 +72,36 @@ class User(Base):
     created_at = Column(DateTime, default=utcnow, nullable=False)
     updated_at = Column(DateTime, default=utcnow, onupdate=utcnow, nullable=False)
 
-    api_keys = relationship("UserApiKey", back_populates="user", cascade="all, delete-orphan")
-    sessions = relationship("UserSession", back_populates="user", cascade="all, delete-orphan")
+    # lazy="raise"：禁止隐式懒加载（N+1），需要时在查询中显式 selectinload
+    api_keys = relationship("UserApiKey", back_populates="user", cascade="all, delete-orphan", lazy="raise")
+    sessions = relationship("UserSession", back_populates="user", cascade="all, delete-orphan", lazy="raise")
     orders = relationship("RechargeOrder", back_populates="user", cascade="all, delete-orphan")
 
+    @cached_property
+    def password_hash_bytes(self) -> bytes:
+        # 哈希为 ASCII 文本；每个实例只编码一次，供 security.verify_password 直接使用
+        return self.password_hash.encode("ascii")
+
+    @validates("password_hash")
+    def _reset_password_hash_bytes(self, key: str, value: str) -> str:
+        # 重新设置哈希（如登录时升级算法）时丢弃已缓存的编码结果
+        self.__dict__.pop("password_hash_bytes", None)
+        return value
+
 
 class UserSession(Base):
     __tablename__ = "sessions"
+    __table_args__ = (
+        # 过期会话清理按 expires_at 范围扫描
+        Index("ix_sessions_expires", "expires_at"),
+    )
 
-    id = Column(String(64), primary_key=True, default=lambda: secrets.token_urlsafe(32))
+    # 主键为 Cookie 令牌（128 位随机字节）的 SHA-256 截断值，令牌本身不落库（见 security.session_key）
+    id = Column(LargeBinary(16), primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     expires_at = Column(DateTime, nullable=False)
+    # 过期时间的 Unix 秒：鉴权时与 time.time() 做整数比较，expires_at 仅用于展示与清理
+    expires_at_epoch = Column(BigInteger, nullable=True)
     created_at = Column(DateTime, default=utcnow, nullable=False)
 
     user = relationship("User", back_populates="sessions")
@@ -86,14 +127,19 @@ class UserApiKey(Base):
 
 class Batch(Base):
     __tablename__ = "batches"
+    __table_args__ = (
+        # “我的批次”分页列表（按创建时间倒序）
+        Index("ix_batches_user_created", "user_id", "created_at"),
+    )
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    # UUIDv7：按时间单调递增，主键 B-tree 近似顺序追加写入
+    id = Column(String(36), primary_key=True, default=uuid7_str)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     prompt = Column(Text, nullable=False)
     model = Column(String(32), nullable=False)
     orientation = Column(String(16), nullable=False)
     size = Column(String(16), nullable=False)
-    duration = Column(Integer, nullable=False)
+    duration = Column(SmallInteger, nullable=False)
     num_videos = Column(Integer, nullable=False)
     image_path = Column(Text, nullable=True)
 
@@ -107,7 +153,8 @@ class Batch(Base):
     updated_at = Column(DateTime, default=utcnow, onupdate=utcnow, nullable=False)
     deleted_at = Column(DateTime, nullable=True)
 
-    tasks = relationship("Task", back_populates="batch", cascade="all, delete-orphan")
+    # lazy="raise"：禁止隐式懒加载（N+1），需要时在查询中显式 selectinload
+    tasks = relationship("Task", back_populates="batch", cascade="all, delete-orphan", lazy="raise")
 
 
 class SmsVerifySession(Base):
@@ -126,8 +173,22 @@ class SmsVerifySession(Base):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # 批次计数器聚合（recompute_batch_counters）；前缀 (batch_id, status) 同时服务按状态分组统计
+        Index("ix_tasks_batch_status_deleted", "batch_id", "status", "deleted_at"),
+        # 按用户、状态筛选并按时间排序的任务查询
+        Index("ix_tasks_user_status_created", "user_id", "status", "created_at"),
+        # 活跃任务按时长统计：部分索引只收录 queued/running 行
+        Index(
+            "ix_tasks_active_duration",
+            "duration",
+            postgresql_where=text("status IN ('queued', 'running')"),
+            sqlite_where=text("status IN ('queued', 'running')"),
+        ),
+    )
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    # UUIDv7：按时间单调递增，主键 B-tree 近似顺序追加写入
+    id = Column(String(36), primary_key=True, default=uuid7_str)
     batch_id = Column(String(36), ForeignKey("batches.id"), nullable=False, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
 
@@ -135,10 +196,22 @@ class Task(Base):
     model = Column(String(32), nullable=False)
     orientation = Column(String(16), nullable=False)
     size = Column(String(16), nullable=False)
-    duration = Column(Integer, nullable=False)
+    duration = Column(SmallInteger, nullable=False)
     image_path = Column(Text, nullable=True)
 
-    status = Column(Enum(TaskStatus), default=TaskStatus.pending, nullable=False)
+    # PostgreSQL 使用原生枚举类型（4 字节），SQLite 等无原生枚举的库退化为 VARCHAR + CHECK 约束；
+    # values_callable 让库中存储枚举值（与成员名一致，兼容已有数据）
+    status = Column(
+        Enum(
+            TaskStatus,
+            name="taskstatus",
+            native_enum=True,
+            create_constraint=True,
+            values_callable=lambda e: [m.value for m in e],
+        ),
+        default=TaskStatus.pending,
+        nullable=False,
+    )
     error_summary = Column(Text, nullable=True)
     progress = Column(String(16), nullable=True)  # 进度信息，如 "50%"
     retries = Column(Integer, default=0, nullable=False)
@@ -154,6 +227,17 @@ class Task(Base):
 
     batch = relationship("Batch", back_populates="tasks")
 
+    @classmethod
+    def bulk_create(cls, session, rows: List[dict]) -> List[str]:
+        """一条多行 INSERT 批量创建任务，返回按 rows 顺序的任务 ID（调用方负责 commit）"""
+        now = utcnow()
+        for row in rows:
+            row.setdefault("id", uuid7_str())
+            row.setdefault("created_at", now)
+            row.setdefault("updated_at", now)
+        session.execute(insert(cls), rows)
+        return [row["id"] for row in rows]
+
     # 时长验证在应用层进行，不使用数据库约束（便于添加新模型）
 
 
@@ -168,6 +252,18 @@ class IdempotencyKey(Base):
 
 class CreditTransaction(Base):
     __tablename__ = "credit_transactions"
+    __table_args__ = (
+        # 积分明细按用户分页、按时间倒序
+        Index("ix_credit_transactions_user_created", "user_id", "created_at"),
+        # 每个任务最多一笔退款：失败路径直接 INSERT ... ON CONFLICT DO NOTHING，无需先查询
+        Index(
+            "uq_credit_refund_per_task",
+            "ref_task_id",
+            unique=True,
+            postgresql_where=text("delta > 0 AND reason LIKE 'refund_task:%'"),
+            sqlite_where=text("delta > 0 AND reason LIKE 'refund_task:%'"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
@@ -182,6 +278,16 @@ class CreditTransaction(Base):
 
 class RechargeOrder(Base):
     __tablename__ = "recharge_orders"
+    __table_args__ = (
+        # 支付状态轮询只关心待支付订单：部分索引（PostgreSQL / SQLite）
+        Index(
+            "ix_orders_user_status",
+            "user_id",
+            "status",
+            postgresql_where=text("status = 'pending'"),
+            sqlite_where=text("status = 'pending'"),
+        ),
+    )
 
     id = Column(String(32), primary_key=True)  # 订单号
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
@@ -194,3 +300,11 @@ class RechargeOrder(Base):
     paid_at = Column(DateTime, nullable=True)
 
     user = relationship("User", back_populates="orders")
+
+
+class ProcessedStripeEvent(Base):
+    __tablename__ = "processed_stripe_events"
+
+    # Stripe 事件 ID（evt_...），用于 Webhook 去重，保证同一事件只入账一次
+    event_id = Column(String(255), primary_key=True)
+    received_at = Column(DateTime, default=utcnow, nullable=False, index=True)
@@ -16,6 +16,11 @@ VEO_PRICING = {
 }
 
 
+# 导入时展开为单层字典，查价只需一次哈希查找
+_FLAT_DURATION_PRICING = {(m, d): c for m, sub in PRICING.items() for d, c in sub.items()}
+_FLAT_SIZE_PRICING = {(m, s): c for m, sub in VEO_PRICING.items() for s, c in sub.items()}
+
+
 def get_unit_cost(model: str, duration: int, size: str = None) -> int:
     """获取单个视频的积分消耗
 
@@ -28,14 +33,10 @@ def get_unit_cost(model: str, duration: int, size: str = None) -> int:
         积分消耗（正整数）
     """
     # veo_3_1 按分辨率定价
+    cost = _FLAT_SIZE_PRICING.get((model, size))
+    if cost is not None:
+        return cost
     if model in VEO_PRICING:
-        return VEO_PRICING[model].get(size, 50)  # 默认1080p价格
+        return 50  # 默认1080p价格
     # 其他模型按时长定价
-    return PRICING.get(model, {}).get(duration, 15)  # 默认15分（兜底）
-
-
-
-
-
-
-
+    return _FLAT_DURATION_PRICING.get((model, duration), 15)  # 默认15分（兜底）
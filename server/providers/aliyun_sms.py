@@ -1,24 +1,11 @@
 from __future__ import annotations
 
 import json
+import threading
 from dataclasses import dataclass
-from typing import Dict, Optional
-
-try:
-    from alibabacloud_dypnsapi20170525 import models as dypns_models
-    from alibabacloud_dypnsapi20170525.client import Client as DypnsapiClient
-    from alibabacloud_tea_openapi import models as open_api_models
-    from alibabacloud_tea_util import models as tea_models
-    from Tea.exceptions import TeaException
-    HAS_ALIYUN_SDK = True
-except ImportError:
-    HAS_ALIYUN_SDK = False
-    # Dummy classes to prevent NameError
-    dypns_models = None
-    DypnsapiClient = None
-    open_api_models = None
-    tea_models = None
-    TeaException = Exception
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Dict, Optional, Tuple
 
 from ..settings import settings
 
@@ -36,6 +23,30 @@ class SendResult:
     sms_code: str
 
 
+def _load_sdk() -> Optional[SimpleNamespace]:
+    """首次发送短信时才导入阿里云 SDK（Tea 依赖链导入耗时较长），未安装返回 None"""
+    try:
+        from alibabacloud_dypnsapi20170525 import models as dypns_models
+        from alibabacloud_dypnsapi20170525.client import Client as DypnsapiClient
+        from alibabacloud_tea_openapi import models as open_api_models
+        from alibabacloud_tea_util import models as tea_models
+        from Tea.exceptions import TeaException
+    except ImportError:
+        return None
+    return SimpleNamespace(
+        dypns_models=dypns_models,
+        DypnsapiClient=DypnsapiClient,
+        open_api_models=open_api_models,
+        tea_models=tea_models,
+        TeaException=TeaException,
+    )
+
+
+@lru_cache(maxsize=64)
+def _encode_template(items: Tuple[Tuple[str, str], ...]) -> str:
+    return json.dumps(dict(items), ensure_ascii=False)
+
+
 class AliyunSmsClient:
     def __init__(
         self,
@@ -44,25 +55,42 @@ class AliyunSmsClient:
         endpoint: str,
         region_id: str,
     ) -> None:
-        self._client: Optional[DypnsapiClient] = None
+        self._client = None
+        self._sdk: Optional[SimpleNamespace] = None
+        self._runtime = None
         self._init_error: Optional[AliyunSmsError] = None
-        
-        if not HAS_ALIYUN_SDK:
-            self._init_error = AliyunSmsError("MissingDependency", "未安装阿里云短信 SDK")
-            return
+        self._lock = threading.Lock()
+        self._access_key_id = access_key_id
+        self._access_key_secret = access_key_secret
+        self._endpoint = endpoint
+        self._region_id = region_id
 
         if not access_key_id or not access_key_secret:
             self._init_error = AliyunSmsError("InvalidAccessKey", "未配置阿里云短信 AccessKey，请检查环境变量")
-            return
-
-        endpoint_host = endpoint.replace("https://", "").replace("http://", "")
-        config = open_api_models.Config(
-            access_key_id=access_key_id,
-            access_key_secret=access_key_secret,
-            endpoint=endpoint_host,
-            region_id=region_id,
-        )
-        self._client = DypnsapiClient(config)
+
+    def _ensure_client(self) -> SimpleNamespace:
+        if self._client is not None:
+            return self._sdk
+        with self._lock:
+            if self._client is None:
+                if self._init_error is not None:
+                    raise self._init_error
+                sdk = _load_sdk()
+                if sdk is None:
+                    self._init_error = AliyunSmsError("MissingDependency", "未安装阿里云短信 SDK")
+                    raise self._init_error
+                endpoint_host = self._endpoint.replace("https://", "").replace("http://", "")
+                config = sdk.open_api_models.Config(
+                    access_key_id=self._access_key_id,
+                    access_key_secret=self._access_key_secret,
+                    endpoint=endpoint_host,
+                    region_id=self._region_id,
+                )
+                self._sdk = sdk
+                # RuntimeOptions 无状态，所有请求共用一个实例
+                self._runtime = sdk.tea_models.RuntimeOptions()
+                self._client = sdk.DypnsapiClient(config)
+        return self._sdk
 
     def send_sms_code(
         self,
@@ -73,13 +101,12 @@ class AliyunSmsClient:
         template_param: Optional[Dict[str, str]] = None,
         expire_seconds: Optional[int] = None,
     ) -> SendResult:
-        if not self._client:
-            raise self._init_error or AliyunSmsError("InvalidAccessKey", "未配置阿里云短信 AccessKey")
-        request = dypns_models.SendSmsVerifyCodeRequest(
+        sdk = self._ensure_client()
+        request = sdk.dypns_models.SendSmsVerifyCodeRequest(
             phone_number=phone_number,
             sign_name=sign_name,
             template_code=template_code,
-            template_param=json.dumps(template_param, ensure_ascii=False) if template_param else None,
+            template_param=_encode_template(tuple(sorted(template_param.items()))) if template_param else None,
             scheme_name=scene,
             valid_time=expire_seconds,
             country_code="86",
@@ -88,10 +115,9 @@ class AliyunSmsClient:
             duplicate_policy=1,
             interval=60,
         )
-        runtime = tea_models.RuntimeOptions()
         try:
-            response = self._client.send_sms_verify_code_with_options(request, runtime)
-        except TeaException as exc:
+            response = self._client.send_sms_verify_code_with_options(request, self._runtime)
+        except sdk.TeaException as exc:
             message = exc.message or "Aliyun SMS error"
             code = exc.code or "AliyunError"
             raise AliyunSmsError(code, message) from exc
@@ -114,17 +140,15 @@ class AliyunSmsClient:
         return SendResult(sms_session_id=session_id, sms_code=verify_code)
 
     def check_sms_code(self, phone_number: str, sms_code: str, scheme_name: Optional[str] = None) -> None:
-        if not self._client:
-            raise self._init_error or AliyunSmsError("InvalidAccessKey", "未配置阿里云短信 AccessKey")
-        request = dypns_models.CheckSmsVerifyCodeRequest(
+        sdk = self._ensure_client()
+        request = sdk.dypns_models.CheckSmsVerifyCodeRequest(
             phone_number=phone_number,
             verify_code=sms_code,
             scheme_name=scheme_name,
         )
-        runtime = tea_models.RuntimeOptions()
         try:
-            self._client.check_sms_verify_code_with_options(request, runtime)
-        except TeaException as exc:
+            self._client.check_sms_verify_code_with_options(request, self._runtime)
+        except sdk.TeaException as exc:
             message = exc.message or "Aliyun SMS error"
             code = exc.code or "AliyunError"
             raise AliyunSmsError(code, message) from exc
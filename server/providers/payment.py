@@ -1,4 +1,5 @@
 import logging
+import threading
 import uuid
 from datetime import datetime
 from typing import Optional, Tuple
@@ -9,14 +10,67 @@ try:
 except ImportError:
     AliPay = None
 
+try:
+    from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
+    from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
+    from alipay.aop.api.domain.AlipayTradePagePayModel import AlipayTradePagePayModel
+    from alipay.aop.api.request.AlipayTradePagePayRequest import AlipayTradePagePayRequest
+    _HAS_ALIPAY = True
+except ImportError:
+    _HAS_ALIPAY = False
+
+try:
+    from wechatpayv3 import WeChatPay, WeChatPayType
+    _HAS_WECHATPAY = True
+except ImportError:
+    _HAS_WECHATPAY = False
+
 from ..models import RechargeOrder, User, utcnow
 from ..settings import settings
 
 logger = logging.getLogger(__name__)
 
+# 套餐金额（分）-> 积分；按整数分查表，避免浮点误差（int(9.9 * 10) == 98）
+_CREDITS_BY_FEN = {990: 100, 4490: 500, 8990: 1000}
+
+
 class PaymentProvider:
     def __init__(self):
         self.mock_mode = True  # 默认为 Mock 模式，除非配置了真实 Key
+        # SDK 客户端构造需要解析 RSA 私钥/公钥，首次使用时构建一次后复用
+        self._alipay_client = None
+        self._wxpay_client = None
+        self._client_lock = threading.Lock()
+
+    def _get_alipay_client(self):
+        if self._alipay_client is None:
+            with self._client_lock:
+                if self._alipay_client is None:
+                    alipay_config = AlipayClientConfig()
+                    alipay_config.server_url = "https://openapi.alipay.com/gateway.do"
+                    alipay_config.app_id = settings.ALIPAY_APP_ID
+                    alipay_config.app_private_key = settings.ALIPAY_PRIVATE_KEY
+                    alipay_config.alipay_public_key = settings.ALIPAY_PUBLIC_KEY
+                    alipay_config.sign_type = "RSA2"
+                    self._alipay_client = DefaultAlipayClient(alipay_config=alipay_config)
+        return self._alipay_client
+
+    def _get_wxpay_client(self):
+        if self._wxpay_client is None:
+            with self._client_lock:
+                if self._wxpay_client is None:
+                    self._wxpay_client = WeChatPay(
+                        wechatpay_type=WeChatPayType.NATIVE,
+                        mchid=settings.WECHAT_PAY_MCH_ID,
+                        private_key=settings.WECHAT_PAY_PRIVATE_KEY,
+                        cert_serial_no=settings.WECHAT_PAY_CERT_SERIAL_NO,
+                        apiv3_key=settings.WECHAT_PAY_APIV3_KEY,
+                        appid=settings.WECHAT_PAY_APP_ID,
+                        notify_url=f"{settings.BASE_URL}/api/recharge/wechat/notify",
+                        cert_dir=None, # 如果需要验证平台证书，可指定目录
+                        logger=logger
+                    )
+        return self._wxpay_client
 
     def calculate_credits(self, amount_cny: float) -> int:
         """
@@ -27,15 +81,8 @@ class PaymentProvider:
         89.9 -> 1000
         其他 -> floor(amount * 10)
         """
-        # 浮点数比较用 epsilon
-        if abs(amount_cny - 9.9) < 0.01:
-            return 100
-        if abs(amount_cny - 44.9) < 0.01:
-            return 500
-        if abs(amount_cny - 89.9) < 0.01:
-            return 1000
-        
-        return int(amount_cny * 10)
+        fen = round(amount_cny * 100)
+        return _CREDITS_BY_FEN.get(fen, fen // 10)
 
     def create_order(self, user_id: int, amount_cny: float, payment_method: str, db_session) -> Tuple[RechargeOrder, dict]:
         """
@@ -86,24 +133,11 @@ class PaymentProvider:
         支付宝支付参数生成
         需要安装: pip install alipay-sdk-python-all
         """
-        try:
-            from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
-            from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
-            from alipay.aop.api.domain.AlipayTradePagePayModel import AlipayTradePagePayModel
-            from alipay.aop.api.request.AlipayTradePagePayRequest import AlipayTradePagePayRequest
-        except ImportError:
+        if not _HAS_ALIPAY:
             logger.error("Alipay SDK not installed. Run: pip install alipay-sdk-python-all")
             return {"error": "Alipay SDK missing"}
 
-        # 配置
-        alipay_config = AlipayClientConfig()
-        alipay_config.server_url = "https://openapi.alipay.com/gateway.do"
-        alipay_config.app_id = settings.ALIPAY_APP_ID
-        alipay_config.app_private_key = settings.ALIPAY_PRIVATE_KEY
-        alipay_config.alipay_public_key = settings.ALIPAY_PUBLIC_KEY
-        alipay_config.sign_type = "RSA2"
-
-        client = DefaultAlipayClient(alipay_config=alipay_config)
+        client = self._get_alipay_client()
 
         # 构造请求
         model = AlipayTradePagePayModel()
@@ -135,24 +169,12 @@ class PaymentProvider:
         微信支付 Native 模式参数生成
         需要安装: pip install wechatpayv3
         """
-        try:
-            from wechatpayv3 import WeChatPay, WeChatPayType
-        except ImportError:
+        if not _HAS_WECHATPAY:
             logger.error("WeChatPay SDK not installed. Run: pip install wechatpayv3")
             return {"error": "WeChatPay SDK missing"}
 
         try:
-            wxpay = WeChatPay(
-                wechatpay_type=WeChatPayType.NATIVE,
-                mchid=settings.WECHAT_PAY_MCH_ID,
-                private_key=settings.WECHAT_PAY_PRIVATE_KEY,
-                cert_serial_no=settings.WECHAT_PAY_CERT_SERIAL_NO,
-                apiv3_key=settings.WECHAT_PAY_APIV3_KEY,
-                appid=settings.WECHAT_PAY_APP_ID,
-                notify_url=f"{settings.BASE_URL}/api/recharge/wechat/notify",
-                cert_dir=None, # 如果需要验证平台证书，可指定目录
-                logger=logger
-            )
+            wxpay = self._get_wxpay_client()
 
             code, message = wxpay.pay(
                 description=f"积分充值-{order.credits}分",
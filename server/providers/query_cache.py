@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from datetime import datetime
+from typing import Optional, Tuple
+
+from ..redis_client import get_async_redis
+from .types import QueryResult, RemoteTaskStatus
+
+logger = logging.getLogger(__name__)
+
+# 远端任务状态短缓存：同一任务的并发轮询/前端刷新在 TTL 内只打一次云雾；
+# 云雾不可达时可回退到 STALE 窗口内的最近结果。只缓存解析后的字段，不存原始响应体
+QUERY_CACHE_TTL_SECONDS = 3
+QUERY_STALE_SECONDS = 60
+QUERY_CACHE_MAXSIZE = 10_000
+# Redis 故障期间每次轮询都会失败，告警按间隔限频，避免刷屏
+REDIS_WARN_INTERVAL_SECONDS = 60
+
+_last_redis_warning = 0.0
+
+# key -> (结果, 写入时间)
+_local: "OrderedDict[str, Tuple[QueryResult, float]]" = OrderedDict()
+
+
+def cache_key(api_base: str, api_key_digest: bytes, task_id: str) -> str:
+    # 与终态缓存一致按 API Key 摘要区分：某个用户 Key 查到的状态不会返回给持有其他 Key 的请求
+    return f"yunwu:q:{api_base}:{api_key_digest.hex()}:{task_id}"
+
+
+def _dumps(result: QueryResult, stored_at: float) -> bytes:
+    fields = asdict(result)
+    fields["status"] = result.status.value
+    for name in ("remote_started_at", "remote_finished_at"):
+        if fields[name] is not None:
+            fields[name] = fields[name].isoformat()
+    # yunwu_client 在模块级导入本模块，这里延迟导入以避免循环依赖
+    from .yunwu_client import json_dumps
+
+    return json_dumps({"r": fields, "t": stored_at})
+
+
+def _loads(raw: bytes) -> Tuple[QueryResult, float]:
+    from .yunwu_client import json_loads
+
+    payload = json_loads(raw)
+    fields = payload["r"]
+    fields["status"] = RemoteTaskStatus(fields["status"])
+    for name in ("remote_started_at", "remote_finished_at"):
+        if fields[name] is not None:
+            fields[name] = datetime.fromisoformat(fields[name])
+    return QueryResult(**fields), payload["t"]
+
+
+def _warn_redis_failure(op: str, exc: Exception) -> None:
+    global _last_redis_warning
+    now = time.time()
+    if now - _last_redis_warning < REDIS_WARN_INTERVAL_SECONDS:
+        return
+    _last_redis_warning = now
+    logger.warning("[query_cache] redis %s failed, using local cache: %s", op, exc)
+
+
+async def _lookup(key: str) -> Optional[Tuple[QueryResult, float]]:
+    redis_client = get_async_redis()
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(key)
+            return _loads(raw) if raw else None
+        except Exception as e:
+            _warn_redis_failure("get", e)
+    return _local.get(key)
+
+
+async def get(key: str, max_age: float = QUERY_CACHE_TTL_SECONDS) -> Optional[QueryResult]:
+    """返回不早于 max_age 秒前写入的结果，否则 None"""
+    entry = await _lookup(key)
+    if entry is None or time.time() - entry[1] > max_age:
+        return None
+    return entry[0]
+
+
+async def put(key: str, result: QueryResult) -> None:
+    now = time.time()
+    redis_client = get_async_redis()
+    if redis_client is not None:
+        try:
+            await redis_client.set(key, _dumps(result, now), ex=QUERY_STALE_SECONDS)
+            return
+        except Exception as e:
+            _warn_redis_failure("set", e)
+    _local[key] = (result, now)
+    _local.move_to_end(key)
+    while len(_local) > QUERY_CACHE_MAXSIZE:
+        _local.popitem(last=False)
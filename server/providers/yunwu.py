@@ -1,23 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import hmac
+import itertools
+import logging
 import os
+import threading
 import time
-import uuid
-from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
 
-import requests
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from ..settings import settings
 from .yunwu_client import create_sora2, query_task
-from .types import RemoteTaskStatus
+from .types import QueryResult, RemoteTaskStatus
 from ..db import SessionLocal
 from ..models import UserApiKey
 from ..crypto import decrypt_text
 
+logger = logging.getLogger(__name__)
 
-def _ensure_dir(path: str) -> None:
-    os.makedirs(path, exist_ok=True)
+# 幂等键：启动时间戳 + 进程号 + 进程内自增计数，跨进程/重启唯一，且无需每次读取随机数
+_BOOT_MS = int(time.time() * 1000)
+_PID = os.getpid()
+_IDEMPOTENCY_COUNTER = itertools.count()
 
 
 def _public_url_for_local_path(filename: str) -> Optional[str]:
@@ -35,19 +44,194 @@ def _public_url_for_local_path(filename: str) -> Optional[str]:
     return f"{settings.PUBLIC_BASE_URL.rstrip('/')}/uploads/{filename}"
 
 
-def _download_to_results(url: str) -> str:
-    _ensure_dir(settings.RESULTS_BASE_DIR)
-    out_path = str(Path(settings.RESULTS_BASE_DIR) / f"{uuid.uuid4()}.mp4")
-    with requests.get(url, stream=True, timeout=settings.REQUEST_TIMEOUT_SECONDS) as r:
-        r.raise_for_status()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-    return out_path
+API_KEY_CACHE_TTL_SECONDS = 300
 
+# user_id -> (解密后的用户级 API Key 或 None, 过期时间戳)
+_api_key_cache: Dict[int, Tuple[Optional[str], float]] = {}
+_api_key_cache_lock = threading.Lock()
 
-def call_yunwu_generate(
+
+def _invalidate_api_key(user_id: int) -> None:
+    with _api_key_cache_lock:
+        _api_key_cache.pop(user_id, None)
+
+
+@event.listens_for(UserApiKey, "after_insert")
+@event.listens_for(UserApiKey, "after_update")
+@event.listens_for(UserApiKey, "after_delete")
+def _on_user_api_key_change(_mapper, _connection, target: UserApiKey) -> None:
+    _invalidate_api_key(target.user_id)
+
+
+def _query_user_api_key(db: Session, user_id: int) -> Optional[str]:
+    rec = (
+        db.query(UserApiKey)
+        .filter(UserApiKey.user_id == user_id, UserApiKey.provider == "yunwu")
+        .first()
+    )
+    if rec is None:
+        return None
+    try:
+        return decrypt_text(rec.encrypted_key)
+    except Exception:
+        return None
+
+
+def _get_user_api_key(user_id: int, db: Optional[Session] = None) -> Optional[str]:
+    """用户级 API Key（带 TTL 缓存），未配置时返回 None；传入 db 时复用调用方会话"""
+    now = time.time()
+    with _api_key_cache_lock:
+        cached = _api_key_cache.get(user_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    if db is None:
+        with SessionLocal() as own_db:
+            api_key = _query_user_api_key(own_db, user_id)
+    else:
+        api_key = _query_user_api_key(db, user_id)
+    with _api_key_cache_lock:
+        _api_key_cache[user_id] = (api_key, now + API_KEY_CACHE_TTL_SECONDS)
+    return api_key
+
+
+def load_api_key(user_id: int, db: Optional[Session] = None) -> Optional[str]:
+    """优先使用用户级API Key；如无则回退至全局环境变量"""
+    api_key = _get_user_api_key(user_id, db)
+    if api_key:
+        logger.debug("[yunwu] using user-level API key for user_id=%s", user_id)
+    else:
+        api_key = settings.YUNWU_API_KEY
+        if api_key:
+            logger.debug("[yunwu] using global YUNWU_API_KEY from environment")
+    return api_key
+
+
+def _sync_task_progress(task_id: str, q: QueryResult) -> None:
+    """更新任务进度到数据库"""
+    from ..models import Task
+    with SessionLocal() as db:
+        db_task = db.get(Task, task_id)
+        if db_task:
+            changed = False
+            # Sync remote status to progress field for visibility
+            status_text = q.status.value
+            if q.progress:
+                status_text = f"{status_text} ({q.progress})"
+
+            if db_task.progress != status_text:
+                db_task.progress = status_text
+                changed = True
+                logger.debug("[yunwu] updated task %s progress to %s", task_id, status_text)
+
+            if q.remote_started_at and db_task.remote_started_at != q.remote_started_at:
+                db_task.remote_started_at = q.remote_started_at
+                changed = True
+                logger.debug("[yunwu] updated task %s remote_started_at=%s", task_id, q.remote_started_at)
+            if q.remote_finished_at and db_task.remote_finished_at != q.remote_finished_at:
+                db_task.remote_finished_at = q.remote_finished_at
+                changed = True
+                logger.debug("[yunwu] updated task %s remote_finished_at=%s", task_id, q.remote_finished_at)
+            if changed:
+                db.add(db_task)
+                db.commit()
+
+
+def callback_signature(task_id: str) -> str:
+    """回调 URL 中携带的任务签名：HMAC-SHA256(YUNWU_CALLBACK_SECRET, 本地任务ID)"""
+    secret = (settings.YUNWU_CALLBACK_SECRET or "").encode()
+    return hmac.new(secret, task_id.encode(), hashlib.sha256).hexdigest()
+
+
+def _callback_url_for(task_id: Optional[str]) -> Optional[str]:
+    if not task_id or not settings.YUNWU_CALLBACK_SECRET or not settings.PUBLIC_BASE_URL:
+        return None
+    query = urlencode({"task_id": task_id, "sig": callback_signature(task_id)})
+    return f"{settings.PUBLIC_BASE_URL.rstrip('/')}/api/yunwu/callback?{query}"
+
+
+class _CallbackWaiter:
+    """等待中的任务：回调到达时写入最新结果并唤醒轮询协程"""
+
+    def __init__(self) -> None:
+        self.event = asyncio.Event()
+        self.result: Optional[QueryResult] = None
+
+
+# 本地任务ID -> 等待者（仅本进程内发起的任务；其他进程收到的回调由兜底轮询处理）
+_callback_waiters: Dict[str, _CallbackWaiter] = {}
+
+
+POLL_CONCURRENCY = 32
+
+
+class _RemotePoller:
+    """所有在途远端任务共用一个轮询协程：每轮并发查询（信号量限流）后把结果分发给各自的等待者。
+
+    多数任务仍在排队时按 1.5 倍退避（上限 MAX_POLL_INTERVAL_SECONDS），否则恢复基础间隔。
+    """
+
+    def __init__(self) -> None:
+        # 远端任务ID -> (API Key, 等待本轮结果的 future 列表)
+        self._waiters: Dict[str, Tuple[str, List[asyncio.Future]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._interval = float(settings.POLL_INTERVAL_SECONDS)
+
+    async def next_status(self, api_key: str, remote_task_id: str) -> QueryResult:
+        """等待下一轮轮询中该远端任务的查询结果"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(remote_task_id, (api_key, []))[1].append(future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+
+        async def poll(api_key: str, remote_task_id: str) -> QueryResult:
+            async with semaphore:
+                return await query_task(api_key=api_key, task_id=remote_task_id)
+
+        # 没有等待者时退出，下次有任务等待时重新启动
+        while self._waiters:
+            await asyncio.sleep(self._interval)
+            batch, self._waiters = self._waiters, {}
+            results = await asyncio.gather(
+                *(poll(api_key, remote_task_id) for remote_task_id, (api_key, _) in batch.items()),
+                return_exceptions=True,
+            )
+            queued = 0
+            for (_, futures), result in zip(batch.values(), results):
+                if isinstance(result, QueryResult) and result.status in {RemoteTaskStatus.pending, RemoteTaskStatus.queued}:
+                    queued += 1
+                for future in futures:
+                    if future.done():
+                        continue
+                    if isinstance(result, BaseException):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            if queued * 2 > len(batch):
+                self._interval = min(self._interval * 1.5, settings.MAX_POLL_INTERVAL_SECONDS)
+            else:
+                self._interval = float(settings.POLL_INTERVAL_SECONDS)
+            logger.debug("[yunwu] poll round: tasks=%s queued=%s next_interval=%.1fs", len(batch), queued, self._interval)
+
+
+remote_poller = _RemotePoller()
+
+
+def deliver_callback(task_id: str, q: QueryResult) -> bool:
+    """把回调结果交给正在等待的任务，返回是否有等待者"""
+    waiter = _callback_waiters.get(task_id)
+    if waiter is None:
+        return False
+    waiter.result = q
+    waiter.event.set()
+    return True
+
+
+async def call_yunwu_generate(
     prompt: str,
     image_path: Optional[str],
     model: str,
@@ -56,52 +240,81 @@ def call_yunwu_generate(
     duration: int,
     user_id: int,
     task_id: Optional[str] = None,
+    api_key: Optional[str] = None,
 ) -> str:
     """Create remote task on Yunwu and poll until completion, then download the video.
 
+    api_key 可由调用方在自己的数据库会话中预先解析（见 load_api_key），省去一次会话开销。
+
     Docs: [创建视频 sora-2](https://yunwu.apifox.cn/api-358068907), [查询任务](https://yunwu.apifox.cn/api-358068905)
     """
-    print(f"[yunwu] call_yunwu_generate: user_id={user_id} model={model} has_image={bool(image_path)}")
+    logger.info("[yunwu] call_yunwu_generate: user_id=%s model=%s has_image=%s", user_id, model, bool(image_path))
     
-    # 优先使用用户级API Key；如无则回退至全局环境变量
-    api_key: Optional[str] = None
-    with SessionLocal() as db:
-        rec = (
-            db.query(UserApiKey)
-            .filter(UserApiKey.user_id == user_id, UserApiKey.provider == "yunwu")
-            .first()
-        )
-        if rec:
-            try:
-                api_key = decrypt_text(rec.encrypted_key)
-                print(f"[yunwu] using user-level API key for user_id={user_id}")
-            except Exception:
-                api_key = None
-    if not api_key:
-        api_key = settings.YUNWU_API_KEY
-        if api_key:
-            print("[yunwu] using global YUNWU_API_KEY from environment")
+    if api_key is None:
+        # 数据库查询与解密放到线程中，避免阻塞事件循环
+        api_key = await asyncio.to_thread(load_api_key, user_id)
     if not api_key:
-        print("[yunwu] ❌ no API key found (neither user-level nor environment)")
+        logger.error("[yunwu] ❌ no API key found (neither user-level nor environment)")
         raise RuntimeError("缺少云雾API密钥：请在个人设置中配置，或设置环境变量 YUNWU_API_KEY")
 
     images: Optional[List[str]] = None
     if image_path:
-        print(f"[yunwu] image_path provided: {image_path}")
+        logger.debug("[yunwu] image_path provided: %s", image_path)
         public_url = _public_url_for_local_path(image_path)
-        print(f"[yunwu] mapped public_url: {public_url}")
+        logger.debug("[yunwu] mapped public_url: %s", public_url)
         if public_url:
             images = [public_url]
         else:
-            print(f"[yunwu] ⚠️  PUBLIC_BASE_URL not set or path mapping failed, sending without images")
+            logger.warning("[yunwu] ⚠️  PUBLIC_BASE_URL not set or path mapping failed, sending without images")
     else:
-        print(f"[yunwu] no image_path provided")
+        logger.debug("[yunwu] no image_path provided")
 
     # 触发创建
-    print(f"[yunwu] creating sora2 task: api_base={settings.YUNWU_API_BASE} has_images={bool(images)} size={size} orientation={orientation} duration={duration}")
+    logger.debug(
+        "[yunwu] creating sora2 task: api_base=%s has_images=%s size=%s orientation=%s duration=%s",
+        settings.YUNWU_API_BASE, bool(images), size, orientation, duration,
+    )
     # 传入幂等键，确保即便上层误触发也不会创建重复远端任务
-    idempotency_key = f"batch-{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}"
-    created = create_sora2(
+    idempotency_key = f"batch-{_BOOT_MS}-{_PID}-{next(_IDEMPOTENCY_COUNTER):08x}"
+    callback_url = _callback_url_for(task_id)
+    waiter: Optional[_CallbackWaiter] = None
+    if callback_url:
+        # 创建前注册，避免回调先于 create 响应到达
+        waiter = _callback_waiters[task_id] = _CallbackWaiter()
+    try:
+        return await _create_and_wait(
+            api_key=api_key,
+            model=model,
+            prompt=prompt,
+            orientation=orientation,
+            size=size,
+            duration=duration,
+            images=images,
+            idempotency_key=idempotency_key,
+            callback_url=callback_url,
+            waiter=waiter,
+            task_id=task_id,
+        )
+    finally:
+        if waiter is not None:
+            _callback_waiters.pop(task_id, None)
+
+
+async def _create_and_wait(
+    *,
+    api_key: str,
+    model: str,
+    prompt: str,
+    orientation: str,
+    size: str,
+    duration: int,
+    images: Optional[List[str]],
+    idempotency_key: str,
+    callback_url: Optional[str],
+    waiter: Optional[_CallbackWaiter],
+    task_id: Optional[str],
+) -> str:
+    created = await create_sora2(
         api_key=api_key,
         model=model,
         prompt=prompt,
@@ -110,49 +323,35 @@ def call_yunwu_generate(
         duration=duration,
         images=images,
         idempotency_key=idempotency_key,
+        callback_url=callback_url,
     )
-    print(f"[yunwu] ✅ created remote task_id={created.task_id}, starting poll...")
+    logger.info("[yunwu] ✅ created remote task_id=%s, starting poll...", created.task_id)
 
-    # 轮询状态
+    # 轮询状态：由进程内统一轮询器按轮次批量查询（见 _RemotePoller），本协程只等待本任务的结果。
+    # 启用回调时主要靠回调唤醒，轮询仅按 YUNWU_CALLBACK_FALLBACK_POLL_SECONDS 兜底
     deadline = time.time() + settings.MAX_POLL_SECONDS
     last_status = None
     while time.time() < deadline:
         try:
-            q = query_task(api_key=api_key, task_id=created.task_id)
-            print(f"[yunwu] poll: status={q.status.value} video_url={q.video_url or 'None'} error={q.error or 'None'} progress={q.progress or 'None'}")
+            if waiter is not None and waiter.result is not None:
+                q, waiter.result = waiter.result, None
+                waiter.event.clear()
+            elif waiter is not None:
+                q = await query_task(api_key=api_key, task_id=created.task_id)
+            else:
+                q = await remote_poller.next_status(api_key, created.task_id)
+            logger.debug(
+                "[yunwu] poll: status=%s video_url=%s error=%s progress=%s",
+                q.status.value, q.video_url, q.error, q.progress,
+            )
             last_status = q.status
             
             # 更新任务进度到数据库（如果提供了task_id）
             if task_id and (q.progress or q.remote_started_at or q.remote_finished_at):
                 try:
-                    from ..models import Task
-                    with SessionLocal() as db:
-                        db_task = db.get(Task, task_id)
-                        if db_task:
-                            changed = False
-                            # Sync remote status to progress field for visibility
-                            status_text = q.status.value
-                            if q.progress:
-                                status_text = f"{status_text} ({q.progress})"
-                            
-                            if db_task.progress != status_text:
-                                db_task.progress = status_text
-                                changed = True
-                                print(f"[yunwu] updated task {task_id} progress to {status_text}")
-
-                            if q.remote_started_at and db_task.remote_started_at != q.remote_started_at:
-                                db_task.remote_started_at = q.remote_started_at
-                                changed = True
-                                print(f"[yunwu] updated task {task_id} remote_started_at={q.remote_started_at}")
-                            if q.remote_finished_at and db_task.remote_finished_at != q.remote_finished_at:
-                                db_task.remote_finished_at = q.remote_finished_at
-                                changed = True
-                                print(f"[yunwu] updated task {task_id} remote_finished_at={q.remote_finished_at}")
-                            if changed:
-                                db.add(db_task)
-                                db.commit()
+                    await asyncio.to_thread(_sync_task_progress, task_id, q)
                 except Exception as pe:
-                    print(f"[yunwu] failed to update progress: {pe}")
+                    logger.warning("[yunwu] failed to update progress: %s", pe)
             
             if q.status == RemoteTaskStatus.completed and q.video_url:
                 # 按需返回远端可访问URL（由前端直接打开），避免本地下载再提供链接
@@ -161,7 +360,11 @@ def call_yunwu_generate(
                 raise RuntimeError(q.error or f"远端任务{q.status.value}")
         except Exception as e:
             # 捕获瞬时网络/解析错误，避免抛给上层导致重复创建远端任务
-            print(f"[yunwu] poll error: {type(e).__name__}: {e}")
-        time.sleep(settings.POLL_INTERVAL_SECONDS)
+            logger.warning("[yunwu] poll error: %s: %s", type(e).__name__, e)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.event.wait(), timeout=settings.YUNWU_CALLBACK_FALLBACK_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
 
     raise TimeoutError(f"远端任务超时，最后状态: {last_status}")
@@ -1,28 +1,116 @@
 from __future__ import annotations
 
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+import hashlib
 import json
-from datetime import datetime
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
 
-import requests
+import httpx
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install httpx[http2]）
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
 
 from ..settings import settings
+from . import query_cache
 from .types import CreateResult, QueryResult, RemoteTaskStatus
-def _parse_timestamp(raw: Optional[object]) -> Optional[datetime]:
-    if raw in (None, "", 0):
+
+logger = logging.getLogger(__name__)
+
+
+# 进程内共享的异步 HTTP 客户端：连接池复用 TCP/TLS，单个事件循环即可并发大量远端任务
+# 安装了 h2 时启用 HTTP/2：同一主机的并发轮询复用单条连接多路传输
+# 注意：传入 transport 时 httpx 忽略客户端上的 limits/http2，需在 transport 上配置
+http_client = httpx.AsyncClient(
+    timeout=settings.REQUEST_TIMEOUT_SECONDS,
+    # 静态头放在客户端上；Authorization/Idempotency-Key 按请求传入，避免不同用户的 Key 串用
+    headers={"Accept": "application/json"},
+    # 建连失败（DNS/TCP/TLS）时自动重试，不重放已发出的请求，避免重复创建远端任务
+    transport=httpx.AsyncHTTPTransport(
+        http2=HAS_HTTP2,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=64),
+        retries=3,
+    ),
+)
+
+
+# 终态查询结果缓存：(API Key 摘要, 远端任务ID) -> (结果, 过期时间)；终态不会再变化，重试/重跑时无需再请求云雾
+TERMINAL_CACHE_TTL_SECONDS = 600
+TERMINAL_CACHE_MAXSIZE = 4096
+_TERMINAL_STATUSES = {RemoteTaskStatus.completed, RemoteTaskStatus.failed, RemoteTaskStatus.cancelled}
+_terminal_cache: "OrderedDict[Tuple[bytes, str], Tuple[QueryResult, float]]" = OrderedDict()
+
+
+@lru_cache(maxsize=128)
+def _api_key_digest(api_key: str) -> bytes:
+    # 各级缓存都按 API Key 摘要区分用户，避免跨用户复用结果；不保存明文 Key
+    return hashlib.blake2b(api_key.encode(), digest_size=8).digest()
+
+
+def _terminal_cache_key(api_key: str, task_id: str) -> Tuple[bytes, str]:
+    return _api_key_digest(api_key), task_id
+
+
+def _get_terminal(key: Tuple[bytes, str]) -> Optional[QueryResult]:
+    cached = _terminal_cache.get(key)
+    if cached is None:
         return None
-    try:
-        val = float(raw)
-    except (TypeError, ValueError):
+    if cached[1] <= time.time():
+        _terminal_cache.pop(key, None)
+        return None
+    return cached[0]
+
+
+def _remember_terminal(key: Tuple[bytes, str], result: QueryResult) -> None:
+    _terminal_cache[key] = (result, time.time() + TERMINAL_CACHE_TTL_SECONDS)
+    _terminal_cache.move_to_end(key)
+    while len(_terminal_cache) > TERMINAL_CACHE_MAXSIZE:
+        _terminal_cache.popitem(last=False)
+
+
+_EPOCH_MS_THRESHOLD = 1e12  # 超过该值视为毫秒级时间戳
+_MAX_EPOCH_SECONDS = 253402300799  # 9999-12-31T23:59:59Z，datetime 可表示的上限
+
+
+def _parse_timestamp(raw: Optional[object]) -> Optional[datetime]:
+    # 数值直接使用（轮询常见路径），仅字符串等其他类型才走 float 转换
+    if isinstance(raw, (int, float)):
+        val = raw
+    elif not raw:
         return None
-    if val <= 0:
+    else:
+        try:
+            val = float(raw)
+        except (TypeError, ValueError):
+            return None
+    # NaN 与任何值比较都为 False，会绕过下面的范围检查
+    if val != val or val <= 0:
         return None
     # 如果是毫秒级时间戳
-    if val > 1e12:
+    if val > _EPOCH_MS_THRESHOLD:
         val /= 1000.0
+    if val > _MAX_EPOCH_SECONDS:
+        return None
     try:
-        return datetime.utcfromtimestamp(val)
-    except (ValueError, OSError, OverflowError):
+        return datetime.fromtimestamp(val, tz=timezone.utc).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
         return None
 
 
@@ -34,19 +122,44 @@ def _mask_token(token: str) -> str:
     return token[:6] + "..." + token[-2:]
 
 
-def _headers(api_key: str) -> Dict[str, str]:
-    return {
-        "Accept": "application/json",
+@lru_cache(maxsize=128)
+def _auth_headers(api_key: str) -> httpx.Headers:
+    # 每个 api_key 只构造一次；httpx 发送时会拷贝，共享实例不会被修改
+    return httpx.Headers({"Authorization": f"Bearer {api_key}"})
+
+
+@lru_cache(maxsize=128)
+def _headers(api_key: str) -> httpx.Headers:
+    return httpx.Headers({
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
-    }
+    })
 
 
 def _resolve_api_base() -> str:
     return settings.YUNWU_API_BASE.rstrip("/")
 
 
-def create_sora2(
+@dataclass(frozen=True)
+class YunwuModelProfile:
+    """各模型在创建请求上的差异，集中在一张表里按模型分派"""
+
+    # True：size 原样透传（veo_3_1 的 720p/1080p/4k）；False：sora 映射 small -> small，其他 -> large
+    passthrough_size: bool = False
+    # 额外固定的 payload 字段
+    extra_payload: Mapping[str, object] = field(default_factory=dict)
+
+
+_DEFAULT_PROFILE = YunwuModelProfile()
+_MODEL_PROFILES: Dict[str, YunwuModelProfile] = {
+    "sora-2-all": _DEFAULT_PROFILE,
+    # sora-2-pro-all 需要 private 字段（根据云雾API文档）
+    "sora-2-pro-all": YunwuModelProfile(extra_payload={"private": False}),
+    "veo_3_1": YunwuModelProfile(passthrough_size=True),
+}
+
+
+async def create_sora2(
     *,
     api_key: str,
     model: str,
@@ -56,6 +169,7 @@ def create_sora2(
     duration: int,
     images: Optional[List[str]] = None,
     idempotency_key: Optional[str] = None,
+    callback_url: Optional[str] = None,
 ) -> CreateResult:
     """Create a Sora2 video generation task on Yunwu.
 
@@ -63,10 +177,9 @@ def create_sora2(
     """
     api_base = _resolve_api_base()
 
-    # veo_3_1 直接使用分辨率值 (720p, 1080p, 4k)
-    # sora 模型映射: small -> small, 其他 -> large
-    if model == "veo_3_1":
-        yunwu_size = size  # 直接使用 720p, 1080p, 4k
+    profile = _MODEL_PROFILES.get(model, _DEFAULT_PROFILE)
+    if profile.passthrough_size:
+        yunwu_size = size
     else:
         yunwu_size = "small" if size == "small" else "large"
 
@@ -79,49 +192,42 @@ def create_sora2(
         # 强制关闭水印
         "watermark": False,
     }
-    # sora-2-pro-all 需要 private 字段（根据云雾API文档）
-    if model == "sora-2-pro-all":
-        payload["private"] = False
-    
+    payload.update(profile.extra_payload)
+
     if images:
         payload["images"] = images
+    if callback_url:
+        payload["callback_url"] = callback_url
 
-    # Debug log: outbound request summary
-    print(
-        "[yunwu_client] POST",
-        f"{api_base}/video/create",
-        f"model={payload['model']} orientation={orientation} size={yunwu_size} duration={duration}",
-        f"images={'True' if images else 'False'} images_count={len(images) if images else 0}",
-    )
-    print(
-        "[yunwu_client] headers.Authorization=Bearer",
-        _mask_token(api_key),
-    )
-    print(
-        "[yunwu_client] prompt_len=",
-        len(prompt),
-        "prompt_preview=",
-        (prompt[:200] + ("..." if len(prompt) > 200 else "")),
-    )
-    try:
-        print("[yunwu_client] payload_json=", json.dumps(payload, ensure_ascii=False))
-    except Exception:
-        pass
+    # 只序列化一次：请求体与调试日志共用同一份 bytes
+    body = json_dumps(payload)
+
+    # Debug log: outbound request summary（仅 DEBUG 级别开启时才格式化/序列化）
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "[yunwu_client] POST %s/video/create model=%s orientation=%s size=%s duration=%s images_count=%s",
+            api_base, payload["model"], orientation, yunwu_size, duration, len(images) if images else 0,
+        )
+        logger.debug("[yunwu_client] headers.Authorization=Bearer %s", _mask_token(api_key))
+        logger.debug(
+            "[yunwu_client] prompt_len=%s prompt_preview=%s",
+            len(prompt), prompt[:200] + ("..." if len(prompt) > 200 else ""),
+        )
+        logger.debug("[yunwu_client] payload_json=%s", body.decode("utf-8"))
 
     headers = _headers(api_key)
     if idempotency_key:
+        headers = headers.copy()
         headers["Idempotency-Key"] = idempotency_key
 
-    resp = requests.post(
+    resp = await http_client.post(
         f"{api_base}/video/create",
         headers=headers,
-        json=payload,
-        timeout=settings.REQUEST_TIMEOUT_SECONDS,
+        content=body,
     )
-    print("[yunwu_client] response_status=", resp.status_code)
+    logger.debug("[yunwu_client] response_status=%s", resp.status_code)
     resp.raise_for_status()
-    data = resp.json()
-    print("[yunwu_client] response_json_keys=", list(data.keys()))
+    data = json_loads(resp.content)
 
     task_id = data.get("id") or data.get("task_id")
     if not task_id:
@@ -130,88 +236,105 @@ def create_sora2(
     return CreateResult(task_id=task_id)
 
 
-def query_task(*, api_key: str, task_id: str) -> QueryResult:
+async def query_task(*, api_key: str, task_id: str, cache_fallback: bool = True) -> QueryResult:
     """Query task status; returns status and optional video URL when completed.
 
+    结果按 (api_base, API Key 摘要, task_id) 短缓存 QUERY_CACHE_TTL_SECONDS 秒；cache_fallback 为真时，
+    请求失败回退到 QUERY_STALE_SECONDS 内的最近结果。
+
     API doc reference: [云雾API 查询任务](https://yunwu.apifox.cn/api-358068905)
     """
+    cache_key = _terminal_cache_key(api_key, task_id)
+    cached = _get_terminal(cache_key)
+    if cached is not None:
+        return cached
+
     api_base = _resolve_api_base()
+    short_key = query_cache.cache_key(api_base, _api_key_digest(api_key), task_id)
+    cached = await query_cache.get(short_key)
+    if cached is not None:
+        return cached
+
     # 根据对方接口：GET /v1/video/query?id={task_id}
     query_url = f"{api_base}/video/query?id={task_id}"
-    print("[yunwu_client] GET", query_url, "Authorization=Bearer", _mask_token(api_key))
-    resp = requests.get(
-        query_url,
-        headers={
-            "Accept": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        timeout=settings.REQUEST_TIMEOUT_SECONDS,
-    )
-    print("[yunwu_client] query_response_status=", resp.status_code)
-    resp.raise_for_status()
-    data = resp.json()
-    print("[yunwu_client] query_response_json_keys=", list(data.keys()))
+    logger.debug("[yunwu_client] GET %s Authorization=Bearer %s", query_url, _mask_token(api_key))
+    try:
+        resp = await http_client.get(
+            query_url,
+            headers=_auth_headers(api_key),
+        )
+        logger.debug("[yunwu_client] query_response_status=%s http_version=%s", resp.status_code, resp.http_version)
+        resp.raise_for_status()
+    except httpx.HTTPError:
+        stale = await query_cache.get(short_key, max_age=query_cache.QUERY_STALE_SECONDS) if cache_fallback else None
+        if stale is None:
+            raise
+        logger.warning("[yunwu_client] query failed, serving cached status for task_id=%s", task_id)
+        return stale
+    data = json_loads(resp.content)
+    result = parse_task_payload(data)
+    if result.status in _TERMINAL_STATUSES:
+        _remember_terminal(cache_key, result)
+    await query_cache.put(short_key, result)
+    return result
+
+
+# 状态映射：SUCCESS -> completed, FAILED -> failed；直接映射到枚举成员，查询时无需再构造枚举
+_STATUS_MAPPING: Dict[str, RemoteTaskStatus] = {
+    "success": RemoteTaskStatus.completed,
+    "failed": RemoteTaskStatus.failed,
+    "failure": RemoteTaskStatus.failed,
+    "error": RemoteTaskStatus.failed,
+    "completed": RemoteTaskStatus.completed,
+    "in-progress": RemoteTaskStatus.in_progress,
+    "processing": RemoteTaskStatus.in_progress,
+    "pending": RemoteTaskStatus.pending,
+    "queued": RemoteTaskStatus.queued,
+}
+# 空格/下划线统一为连字符（"in progress" / "in_progress" -> "in-progress"），一次 C 层 translate 完成
+_SPACE_TO_DASH = str.maketrans(" _", "--")
+# 响应缺少内层 data 对象时的只读占位，避免每次分配空字典
+_EMPTY: Dict[str, Any] = {}
+
+
+def parse_task_payload(data: Dict) -> QueryResult:
+    """解析云雾任务状态 JSON（查询接口响应与任务回调共用同一结构）"""
+    # 内层 data 对象只取一次，后续字段直接从 inner / data 读取
+    inner = data.get("data")
+    if not isinstance(inner, dict):
+        inner = _EMPTY
 
     # 云雾状态字段：优先使用 data.status（completed），回退到外层 status（SUCCESS）
     # 外层 status 可能是 SUCCESS/FAILED，内层 data.status 是 completed/failed
-    status_raw = ""
-    if "data" in data and isinstance(data.get("data"), dict):
-        status_raw = (data["data"].get("status") or "").lower()
-    if not status_raw:
-        status_raw = (data.get("status") or "").lower()
-    
-    # 状态映射：SUCCESS -> completed, FAILED -> failed
-    status_mapping = {
-        "success": "completed",
-        "failed": "failed",
-        "failure": "failed",
-        "error": "failed",
-        "completed": "completed",
-        "in-progress": "in-progress",
-        "in_progress": "in-progress",
-        "processing": "in-progress",
-        "pending": "pending",
-        "queued": "queued",
-    }
-    status = status_mapping.get(status_raw.replace(" ", "-"), RemoteTaskStatus.in_progress.value)
-    print(f"[yunwu_client] status_raw={status_raw}, mapped_status={status}")
+    status_raw = (inner.get("status") or data.get("status") or "").lower()
+    status = _STATUS_MAPPING.get(status_raw.translate(_SPACE_TO_DASH), RemoteTaskStatus.in_progress)
+    logger.debug("[yunwu_client] status_raw=%s, mapped_status=%s", status_raw, status.value)
 
     # video_url 也可能在 data 对象中
-    video_url = None
-    if "data" in data and isinstance(data.get("data"), dict):
-        video_url = data["data"].get("video_url")
-    if not video_url:
-        video_url = data.get("video_url") or data.get("result_url")
+    video_url = inner.get("video_url") or data.get("video_url") or data.get("result_url")
 
     # 提取进度信息：优先从外层 progress 获取，格式如 "50%"
     progress = data.get("progress")
-    if not progress and "data" in data and isinstance(data.get("data"), dict):
+    if not progress:
         # 也尝试从 data.progress 获取数字进度，转换为百分比
-        data_progress = data["data"].get("progress")
+        data_progress = inner.get("progress")
         if data_progress is not None:
             try:
                 # 如果是数字（0-100），转换为百分比字符串
-                progress_num = int(data_progress)
-                progress = f"{progress_num}%"
+                progress = f"{int(data_progress)}%"
             except (ValueError, TypeError):
                 pass
 
     # 远端时间戳（秒）
-    start_time = data.get("start_time")
-    finish_time = data.get("finish_time")
-    submit_time = data.get("submit_time")
-    if "data" in data and isinstance(data.get("data"), dict):
-        start_time = start_time or data["data"].get("start_time") or data["data"].get("created_at")
-        finish_time = finish_time or data["data"].get("finish_time") or data["data"].get("completed_at")
-        submit_time = submit_time or data["data"].get("submit_time")
+    start_time = data.get("start_time") or inner.get("start_time") or inner.get("created_at")
+    finish_time = data.get("finish_time") or inner.get("finish_time") or inner.get("completed_at")
+    submit_time = data.get("submit_time") or inner.get("submit_time")
 
     return QueryResult(
-        status=RemoteTaskStatus(status),
+        status=status,
         video_url=video_url,
         error=data.get("error") or data.get("message") or data.get("fail_reason"),
         progress=progress,
         remote_started_at=_parse_timestamp(start_time or submit_time),
         remote_finished_at=_parse_timestamp(finish_time),
     )
-
-
@@ -1,26 +1,34 @@
 from __future__ import annotations
 
 import asyncio
-from collections import defaultdict, deque
-from typing import Deque, Dict, Optional
+import logging
+from typing import Optional, Tuple
 
 from sqlalchemy.orm import Session
 
 from .db import SessionLocal
-from .models import Task, TaskStatus, CreditTransaction
-from .providers.yunwu import call_yunwu_generate
-from .settings import settings
-from .batch_utils import recompute_batch_counters
+from .models import Task, TaskStatus
+from .providers.yunwu import call_yunwu_generate, load_api_key
+from .batch_utils import has_counter_triggers, record_task_change, record_task_transition, refund_task_once
+from .concurrency import ConcurrencyLimiter
 from .pricing import get_unit_cost
 
 
+logger = logging.getLogger(__name__)
+
+# 槽位被其他进程（经 Redis 共享计数）释放时本进程收不到通知，按此间隔兜底重试
+SLOT_RECHECK_SECONDS = 1.0
+
+
 class AsyncTaskExecutor:
     def __init__(self) -> None:
-        self._queue: Deque[str] = deque()
-        self._global_running: int = 0
-        self._user_running: Dict[int, int] = defaultdict(int)
+        self._queue: "asyncio.Queue[Tuple[str, int]]" = asyncio.Queue()
+        self._limiter = ConcurrencyLimiter()
+        self._slot_freed = asyncio.Event()
         self._loop_task: Optional[asyncio.Task] = None
         self._stop = asyncio.Event()
+        # 领取任务专用的长生命周期会话：仅由 _worker_loop 使用，避免每个任务都新建会话
+        self._claim_db: Optional[Session] = None
 
     def start(self) -> None:
         if self._loop_task is None:
@@ -29,52 +37,86 @@ class AsyncTaskExecutor:
     async def stop(self) -> None:
         if self._loop_task:
             self._stop.set()
-            await self._loop_task
+            # 循环可能阻塞在 queue.get / 等待槽位上，直接取消
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
             self._loop_task = None
+        self._drop_claim_db()
+
+    def _drop_claim_db(self) -> None:
+        if self._claim_db is not None:
+            try:
+                self._claim_db.close()
+            except Exception:
+                pass
+            self._claim_db = None
 
-    def enqueue_task(self, task_id: str) -> None:
-        self._queue.append(task_id)
+    def enqueue_task(self, task_id: str, user_id: int) -> None:
+        # 队列中带上 user_id，调度时无需先查库即可做并发准入判断
+        self._queue.put_nowait((task_id, user_id))
+
+    async def _wait_for_slot(self, user_id: int) -> str:
+        """占用全局与用户槽位；已满时等待本进程有任务结束（或兜底超时）后重试"""
+        while True:
+            self._slot_freed.clear()
+            slot = await self._limiter.acquire(user_id)
+            if slot is not None:
+                return slot
+            try:
+                await asyncio.wait_for(self._slot_freed.wait(), timeout=SLOT_RECHECK_SECONDS)
+            except asyncio.TimeoutError:
+                pass
 
     async def _worker_loop(self) -> None:
         while not self._stop.is_set():
-            await asyncio.sleep(0.1)
-            if not self._queue:
-                continue
+            # 新任务入队即唤醒，无需定时轮询
+            task_id, user_id = await self._queue.get()
 
-            task_id = self._queue[0]
-            with SessionLocal() as db:
-                task: Optional[Task] = db.get(Task, task_id)
-                if task is None:
-                    self._queue.popleft()
-                    continue
-                user_id = task.user_id
-
-                # 并发与配额检查（不从队列移除）
-                if self._global_running >= settings.GLOBAL_CONCURRENCY:
-                    continue
-                if self._user_running[user_id] >= settings.PER_USER_CONCURRENCY:
-                    continue
-
-                # 原子"领取"任务：仅当当前仍为 pending/queued 才置为 running
-                affected = (
-                    db.query(Task)
-                    .filter(Task.id == task_id, Task.status.in_([TaskStatus.pending, TaskStatus.queued]))
-                    .update({Task.status: TaskStatus.running})
-                )
-                db.commit()
+            # 并发与配额检查：队首任务拿到槽位前不调度后续任务（保持 FIFO），槽位已满时不访问数据库
+            slot = await self._wait_for_slot(user_id)
+
+            try:
+                claimed = self._claim(task_id)
+            except Exception:
+                # 数据库瞬时故障：归还槽位并丢弃可能已损坏的会话，调度循环继续运行
+                logger.exception("[queue] claim failed for task %s", task_id)
+                await self._limiter.release(user_id, slot)
+                self._slot_freed.set()
+                self._drop_claim_db()
+                continue
 
-                if affected == 0:
-                    # 已被其他执行器领取，弹出并跳过
-                    self._queue.popleft()
-                    continue
+            if not claimed:
+                # 已被其他执行器领取或不存在，归还槽位并跳过
+                await self._limiter.release(user_id, slot)
+                continue
 
-                # 领取成功后再弹出队列并启动执行
-                self._queue.popleft()
-                asyncio.create_task(self._execute_task(task_id, user_id))
+            asyncio.create_task(self._execute_task(task_id, user_id, slot))
 
-    async def _execute_task(self, task_id: str, user_id: int) -> None:
-        self._global_running += 1
-        self._user_running[user_id] += 1
+    def _claim(self, task_id: str) -> bool:
+        """原子"领取"任务：仅当当前仍为 pending/queued 才置为 running（任务已删除时影响 0 行）"""
+        if self._claim_db is None:
+            self._claim_db = SessionLocal()
+        db = self._claim_db
+        try:
+            affected = (
+                db.query(Task)
+                .filter(Task.id == task_id, Task.status.in_([TaskStatus.pending, TaskStatus.queued]))
+                .update({Task.status: TaskStatus.running}, synchronize_session=False)
+            )
+            if affected and not has_counter_triggers(db):
+                batch_id = db.query(Task.batch_id).filter(Task.id == task_id).scalar()
+                record_task_change(db, batch_id, TaskStatus.queued, TaskStatus.running)
+            # 提交即归还连接，会话本身（不加载实体，身份映射为空）留待下次复用
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return affected > 0
+
+    async def _execute_task(self, task_id: str, user_id: int, slot: str) -> None:
         try:
             # 仅执行一次；远端创建+轮询在 provider 内部完成，避免重复创建
             try:
@@ -84,35 +126,17 @@ class AsyncTaskExecutor:
                 with SessionLocal() as db:
                     task = db.get(Task, task_id)
                     if task:
+                        record_task_transition(db, task, TaskStatus.failed)
                         task.status = TaskStatus.failed
                         task.error_summary = str(exc)[:500]
                         db.add(task)
                         # 失败退款（避免重复退款）
                         unit_cost = get_unit_cost(task.model, int(task.duration), task.size)
-                        exists = (
-                            db.query(CreditTransaction)
-                            .filter(
-                                CreditTransaction.user_id == task.user_id,
-                                CreditTransaction.ref_task_id == task.id,
-                                CreditTransaction.delta > 0,
-                            )
-                            .first()
-                        )
-                        if not exists:
-                            db.add(
-                                CreditTransaction(
-                                    user_id=task.user_id,
-                                    delta=unit_cost,
-                                    reason=f"refund_task:{task.id}",
-                                    ref_task_id=task.id,
-                                    ref_batch_id=task.batch_id,
-                                )
-                            )
+                        refund_task_once(db, task, unit_cost)
                         db.commit()
-                        recompute_batch_counters(db, task.batch_id)
         finally:
-            self._global_running -= 1
-            self._user_running[user_id] -= 1
+            await self._limiter.release(user_id, slot)
+            self._slot_freed.set()
 
     async def _run_with_retries(self, task_id: str) -> None:
         backoffs = [2, 5]
@@ -127,44 +151,26 @@ class AsyncTaskExecutor:
                     with SessionLocal() as db:
                         task = db.get(Task, task_id)
                         if task:
+                            record_task_transition(db, task, TaskStatus.failed)
                             task.status = TaskStatus.failed
                             task.error_summary = str(exc)[:500]
                             db.add(task)
                             # 失败退款（避免重复退款）
                             unit_cost = get_unit_cost(task.model, int(task.duration))
-                            exists = (
-                                db.query(CreditTransaction)
-                                .filter(
-                                    CreditTransaction.user_id == task.user_id,
-                                    CreditTransaction.ref_task_id == task.id,
-                                    CreditTransaction.delta > 0,
-                                )
-                                .first()
-                            )
-                            if not exists:
-                                db.add(
-                                    CreditTransaction(
-                                        user_id=task.user_id,
-                                        delta=unit_cost,
-                                        reason=f"refund_task:{task.id}",
-                                        ref_task_id=task.id,
-                                        ref_batch_id=task.batch_id,
-                                    )
-                                )
+                            refund_task_once(db, task, unit_cost)
                             db.commit()
-                            recompute_batch_counters(db, task.batch_id)
                     return
                 await asyncio.sleep(backoffs[attempt - 1])
 
     async def _execute_once(self, task_id: str) -> None:
-        def sync_call() -> str:
+        def load_params() -> Optional[dict]:
             with SessionLocal() as db:
                 task = db.get(Task, task_id)
                 if task is None:
                     raise RuntimeError("Task not found")
                 if task.status == TaskStatus.cancelled:
-                    return ""
-                out_path = call_yunwu_generate(
+                    return None
+                return dict(
                     prompt=task.prompt,
                     image_path=task.image_path,
                     model=task.model,
@@ -173,15 +179,27 @@ class AsyncTaskExecutor:
                     duration=task.duration,
                     user_id=task.user_id,
                     task_id=task.id,
+                    # 复用本会话解析 API Key，避免 call_yunwu_generate 再开一个会话
+                    api_key=load_api_key(task.user_id, db),
                 )
+
+        def save_result(out_path: str) -> None:
+            with SessionLocal() as db:
+                task = db.get(Task, task_id)
+                if task is None:
+                    return
                 task.result_path = out_path
+                record_task_transition(db, task, TaskStatus.completed)
                 task.status = TaskStatus.completed
                 db.add(task)
                 db.commit()
-                recompute_batch_counters(db, task.batch_id)
-                return out_path
 
-        await asyncio.to_thread(sync_call)
+        params = await asyncio.to_thread(load_params)
+        if params is None:
+            return
+        # 远端创建与轮询在事件循环上异步进行，不再占用工作线程
+        out_path = await call_yunwu_generate(**params)
+        await asyncio.to_thread(save_result, out_path)
 
 
 executor = AsyncTaskExecutor()
@@ -1,26 +1,68 @@
 from __future__ import annotations
 
+import threading
 import time
-from collections import defaultdict, deque
-from typing import Deque, Dict
+from typing import Dict, Tuple
 
+from .redis_client import get_redis
 from .settings import settings
 
 
+WINDOW_SECONDS = 60
+
+
 class PerUserRateLimiter:
+    """每用户每分钟创建批次数限制。
+
+    配置了 Redis 时使用 INCR + EXPIRE 固定窗口（多 worker 共享计数）；否则在进程内用
+    滚动位掩码：一个大整数打包 60 个每秒计数槽，左移即滑动窗口，乘法把所有槽累加到最高槽，
+    每次调用为 O(1) 整数运算，无需遍历/弹出时间戳。
+    """
+
     def __init__(self) -> None:
-        self._events: Dict[int, Deque[float]] = defaultdict(deque)
+        # user_id -> (最近一次记录的秒, 打包的每秒计数)
+        self._masks: Dict[int, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
 
     def allow_new_batch(self, user_id: int) -> bool:
-        now = time.time()
-        window = 60.0
-        dq = self._events[user_id]
-        while dq and now - dq[0] > window:
-            dq.popleft()
-        if len(dq) >= settings.MAX_BATCHES_PER_USER_PER_MINUTE:
-            return False
-        dq.append(now)
-        return True
+        limit = settings.MAX_BATCHES_PER_USER_PER_MINUTE
+        redis_client = get_redis()
+        if redis_client is not None:
+            try:
+                return self._allow_redis(redis_client, user_id, limit)
+            except Exception as e:
+                print(f"[rate_limit] redis unavailable, falling back to local limiter: {e}")
+        return self._allow_local(user_id, limit)
+
+    @staticmethod
+    def _allow_redis(redis_client, user_id: int, limit: int) -> bool:
+        key = f"rl:batch:{user_id}:{int(time.time()) // WINDOW_SECONDS}"
+        pipe = redis_client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, WINDOW_SECONDS)
+        count, _ = pipe.execute()
+        return count <= limit
+
+    def _allow_local(self, user_id: int, limit: int) -> bool:
+        # 每槽位宽保证总数 <= limit 时不溢出，乘法累加结果落在最高槽
+        lane_bits = max(1, limit.bit_length())
+        lane_mask = (1 << lane_bits) - 1
+        window_mask = (1 << (lane_bits * WINDOW_SECONDS)) - 1
+        ones = window_mask // lane_mask  # 每个槽位为 1 的常量
+        now_s = int(time.time())
+        with self._lock:
+            last_s, mask = self._masks.get(user_id, (now_s, 0))
+            delta = now_s - last_s
+            if delta >= WINDOW_SECONDS:
+                mask = 0
+            elif delta > 0:
+                mask = (mask << (lane_bits * delta)) & window_mask
+            count = ((mask * ones) >> (lane_bits * (WINDOW_SECONDS - 1))) & lane_mask
+            if count >= limit:
+                self._masks[user_id] = (now_s, mask)
+                return False
+            self._masks[user_id] = (now_s, mask + 1)
+            return True
 
 
 rate_limiter = PerUserRateLimiter()
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from typing import Optional
+
+try:
+    import redis
+    from redis import asyncio as redis_asyncio
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+    redis = None
+    redis_asyncio = None
+
+from .settings import settings
+
+
+_sync_client: Optional["redis.Redis"] = None
+_async_client: Optional["redis_asyncio.Redis"] = None
+
+
+def get_redis() -> Optional["redis.Redis"]:
+    """Shared synchronous Redis client, or None when REDIS_URL is unset / redis is not installed."""
+    global _sync_client
+    if _sync_client is None and HAS_REDIS and settings.REDIS_URL:
+        _sync_client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=1.0)
+    return _sync_client
+
+
+def get_async_redis() -> Optional["redis_asyncio.Redis"]:
+    """Shared asyncio Redis client, or None when REDIS_URL is unset / redis is not installed."""
+    global _async_client
+    if _async_client is None and HAS_REDIS and settings.REDIS_URL:
+        _async_client = redis_asyncio.Redis.from_url(settings.REDIS_URL, socket_timeout=1.0)
+    return _async_client
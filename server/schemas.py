@@ -1,30 +1,34 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Any, Generic, Literal, Optional, TypeVar
+from typing import Any, Generic, List, Literal, Optional, Type, TypeVar
 
-from pydantic import BaseModel, Field
-try:
-    from pydantic.generics import GenericModel
-except Exception:
-    GenericModel = BaseModel
+from fastapi import Response
+from pydantic import BaseModel, ConfigDict, Field
 
 
 T = TypeVar("T")
 
+# 请求体只读：校验后不再修改，多余字段直接忽略
+_REQUEST_CONFIG = ConfigDict(frozen=True, extra="ignore")
+# 响应模型可直接从 ORM 对象按属性读取
+_READ_CONFIG = ConfigDict(from_attributes=True)
+
 
 class ApiError(BaseModel):
     message: str
     code: Optional[str] = None
 
 
-class ApiResponse(GenericModel, Generic[T]):
+class ApiResponse(BaseModel, Generic[T]):
     ok: bool = Field(..., description="Indicates success")
     data: Optional[T] = None
     error: Optional[ApiError] = None
 
 
 class LoginRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     username: str
     password: str
 
@@ -38,6 +42,8 @@ class MeResponse(BaseModel):
 
 
 class BatchCreateRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     prompt: str
     model: Literal["sora-2-all", "sora-2-pro-all", "veo_3_1"]
     orientation: Literal["portrait", "landscape"]
@@ -48,6 +54,8 @@ class BatchCreateRequest(BaseModel):
 
 
 class ApiKeySetRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     provider: str
     api_key: str
 
@@ -58,12 +66,16 @@ class ApiKeyGetResponse(BaseModel):
 
 
 class CreditAdjustRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     user_id: int
     delta: int
     reason: str = Field(min_length=1, max_length=64)
 
 
 class TaskRead(BaseModel):
+    model_config = _READ_CONFIG
+
     id: str
     batch_id: str
     status: str
@@ -77,6 +89,8 @@ class TaskRead(BaseModel):
 
 
 class BatchRead(BaseModel):
+    model_config = _READ_CONFIG
+
     id: str
     prompt: str
     model: str
@@ -94,18 +108,37 @@ class BatchRead(BaseModel):
     updated_at: datetime
 
 
+class BatchPage(BaseModel):
+    items: List[BatchRead]
+    page: int
+    page_size: int
+    total: int
+    total_pages: int
+
+
+# 高频接口的具体化响应类型（导入时完成泛型特化），配合 ok_json 直接输出 JSON 字节
+TaskListResponse = ApiResponse[List[TaskRead]]
+BatchPageResponse = ApiResponse[BatchPage]
+
+
 class SmsSendRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     mobile: str
     scene: Optional[str] = Field(default="login", max_length=32)
 
 
 class SmsVerifyRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     mobile: str
     code: str = Field(min_length=4, max_length=10)
     scene: Optional[str] = Field(default="login", max_length=32)
 
 
 class RechargeCreateRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
+
     amount: float  # 元
     payment_method: Literal["alipay", "wechat"]
     credits: Optional[int] = None # 如果是自定义金额，可能会自动计算，或者由前端传
@@ -132,6 +165,14 @@ class CreditTransactionRead(BaseModel):
     ref_batch_id: Optional[str] = None
 
 
+MeApiResponse = ApiResponse[MeResponse]
+
+
+def ok_json(response_cls: Type[ApiResponse[Any]], data: Any) -> Response:
+    """用具体化的 ApiResponse[...] 序列化成功响应，跳过 FastAPI response_model 的二次校验与序列化"""
+    return Response(response_cls(ok=True, data=data).model_dump_json(), media_type="application/json")
+
+
 def ok(data: Any) -> ApiResponse[Any]:
     return ApiResponse(ok=True, data=data)
 
@@ -1,68 +1,222 @@
 from __future__ import annotations
 
-from datetime import datetime
-from typing import Optional
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple, Union
 
 import bcrypt
 from fastapi import Cookie, Depends, HTTPException, Response, status
+from sqlalchemy import bindparam, select
 from sqlalchemy.orm import Session
 
 from .db import get_db
 from .models import User, UserSession
 from .settings import settings
 
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+
+    _argon2 = PasswordHasher()
+    _HAS_ARGON2 = True
+except ImportError:
+    _argon2 = None
+    _HAS_ARGON2 = False
+
+
+# 启动后不变的会话配置：导入时取一次，每个响应不再重复计算
+_SESSION_COOKIE_NAME = settings.SESSION_COOKIE_NAME
+_SESSION_MAX_AGE = int(settings.SESSION_TTL.total_seconds())
+_SESSION_COOKIE_KWARGS = dict(
+    key=_SESSION_COOKIE_NAME,
+    httponly=True,
+    max_age=_SESSION_MAX_AGE,
+    samesite="lax",
+    secure=False,
+    path="/",
+)
+
+# 会话缓存：session_key(令牌) -> (user_id, 过期 Unix 秒, 写入时间)，命中时省去 sessions 表查询。
+# 登出时本进程立即失效；其他 worker 最多沿用 TTL 秒
+SESSION_CACHE_TTL_SECONDS = 60
+SESSION_CACHE_MAXSIZE = 10_000
+_session_cache: "OrderedDict[bytes, Tuple[int, float, float]]" = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+
+def _cached_session(session_id: bytes) -> Optional[Tuple[int, float]]:
+    with _session_cache_lock:
+        entry = _session_cache.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[2] > SESSION_CACHE_TTL_SECONDS:
+            del _session_cache[session_id]
+            return None
+        return entry[0], entry[1]
+
+
+def _cache_session(session_id: bytes, user_id: int, expires_at_epoch: float) -> None:
+    with _session_cache_lock:
+        _session_cache[session_id] = (user_id, expires_at_epoch, time.monotonic())
+        _session_cache.move_to_end(session_id)
+        while len(_session_cache) > SESSION_CACHE_MAXSIZE:
+            _session_cache.popitem(last=False)
+
+
+def _use_argon2() -> bool:
+    # 配置为 argon2 但未安装 argon2-cffi 时退回 bcrypt
+    return settings.PASSWORD_HASH_SCHEME == "argon2" and _HAS_ARGON2
+
 
 def hash_password(raw_password: str) -> str:
+    if _use_argon2():
+        return _argon2.hash(raw_password)
     # 使用原生 bcrypt 库
     password_bytes = raw_password.encode('utf-8')
-    hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt())
+    hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS))
     return hashed.decode('utf-8')
 
 
-def verify_password(raw_password: str, password_hash: str) -> bool:
+def verify_password(raw_password: str, password_hash: Union[str, bytes]) -> bool:
+    # 哈希均为 ASCII；传入 bytes（如 User.password_hash_bytes）时不再逐次编码
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('ascii')
+    # 按哈希前缀选择算法：$argon2 为 argon2id，$2 为 bcrypt（历史哈希）
+    if password_hash.startswith(b"$argon2"):
+        if not _HAS_ARGON2:
+            return False
+        try:
+            return _argon2.verify(password_hash, raw_password)
+        except (VerificationError, InvalidHashError):
+            return False
     # 使用原生 bcrypt 库验证
-    password_bytes = raw_password.encode('utf-8')
-    hash_bytes = password_hash.encode('utf-8')
-    return bcrypt.checkpw(password_bytes, hash_bytes)
+    return bcrypt.checkpw(raw_password.encode('utf-8'), password_hash)
+
+
+# 导入时按当前算法/成本生成一次，首个不存在用户的登录也不会因现算哈希而变慢
+_DUMMY_HASH = hash_password(secrets.token_urlsafe(16)).encode('ascii')
+
+
+def verify_user_password(user: Optional[User], raw_password: str) -> bool:
+    """用户不存在时也对占位哈希做一次校验，两条路径耗时一致，避免按响应时间探测用户名是否存在"""
+    if user is None:
+        verify_password(raw_password, _DUMMY_HASH)
+        return False
+    return verify_password(raw_password, user.password_hash_bytes)
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """哈希算法与当前配置不一致或强度低于当前配置时返回 True，登录成功后可据此透明升级"""
+    if _use_argon2():
+        return not password_hash.startswith("$argon2") or _argon2.check_needs_rehash(password_hash)
+    if not password_hash.startswith("$2"):
+        return False
+    # bcrypt 哈希格式：$2b$<cost>$...
+    try:
+        # 只升不降：存量成本高于当前配置时保留原哈希
+        return int(password_hash.split("$")[2]) < settings.BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
 
+def encode_session_token(session_id: bytes) -> str:
+    return base64.urlsafe_b64encode(session_id).rstrip(b"=").decode("ascii")
 
-def create_session(db: Session, user: User) -> UserSession:
-    expires_at = datetime.utcnow() + settings.SESSION_TTL
-    session = UserSession(user_id=user.id, expires_at=expires_at)
-    db.add(session)
+
+def decode_session_token(token: str) -> Optional[bytes]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    return raw if len(raw) == 16 else None
+
+
+def session_key(token: bytes) -> bytes:
+    """数据库中只存 Cookie 令牌的 SHA-256（截断为 16 字节）：主键比较的是哈希，
+    按首个不同字节提前返回的 B-tree 比较不再泄露真实令牌前缀，泄露的表数据也不能直接登录"""
+    return hashlib.sha256(token).digest()[:16]
+
+
+def create_session(db: Session, user: User) -> bytes:
+    """创建会话并返回 Cookie 令牌（原始随机字节，不落库）"""
+    token = secrets.token_bytes(16)
+    expires_at_epoch = int(time.time()) + _SESSION_MAX_AGE
+    db.add(UserSession(
+        id=session_key(token),
+        user_id=user.id,
+        expires_at=datetime.fromtimestamp(expires_at_epoch, tz=timezone.utc).replace(tzinfo=None),
+        expires_at_epoch=expires_at_epoch,
+    ))
     db.commit()
-    db.refresh(session)
-    return session
+    return token
 
 
-def set_session_cookie(response: Response, session_id: str) -> None:
-    response.set_cookie(
-        key=settings.SESSION_COOKIE_NAME,
-        value=session_id,
-        httponly=True,
-        max_age=int(settings.SESSION_TTL.total_seconds()),
-        samesite="lax",
-        secure=False,
-        path="/",
-    )
+def set_session_cookie(response: Response, token: bytes) -> None:
+    response.set_cookie(value=encode_session_token(token), **_SESSION_COOKIE_KWARGS)
 
 
 def clear_session_cookie(response: Response) -> None:
-    response.delete_cookie(key=settings.SESSION_COOKIE_NAME, path="/")
+    response.delete_cookie(key=_SESSION_COOKIE_NAME, path="/")
+
+
+def revoke_session(db: Session, token: Optional[str]) -> None:
+    """删除会话记录并清除本进程缓存（登出）"""
+    raw = decode_session_token(token) if token else None
+    if raw is None:
+        return
+    key = session_key(raw)
+    with _session_cache_lock:
+        _session_cache.pop(key, None)
+    db.query(UserSession).filter(UserSession.id == key).delete(synchronize_session=False)
+    db.commit()
+
+
+# 模块级语句 + 绑定参数：每次请求复用同一语句对象，编译结果命中 SQLAlchemy 编译缓存
+_SESSION_USER_STMT = (
+    select(User, UserSession.id, UserSession.expires_at, UserSession.expires_at_epoch)
+    .join(UserSession, UserSession.user_id == User.id)
+    .where(UserSession.id == bindparam("key"))
+)
 
 
 def get_current_user(
     db: Session = Depends(get_db),
-    session_id: Optional[str] = Cookie(default=None, alias=settings.SESSION_COOKIE_NAME),
+    session_id: Optional[str] = Cookie(default=None, alias=_SESSION_COOKIE_NAME),
 ) -> User:
     if not session_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    session: Optional[UserSession] = db.get(UserSession, session_id)
-    if session is None or session.expires_at <= datetime.utcnow():
+    raw = decode_session_token(session_id)
+    if raw is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session expired")
+    key = session_key(raw)
+
+    cached = _cached_session(key)
+    if cached is None:
+        # 缓存未命中：会话与用户一条 JOIN 取回
+        row = db.execute(_SESSION_USER_STMT, {"key": key}).first()
+        if row is None or not hmac.compare_digest(row.id, key):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session expired")
+        user: Optional[User] = row.User
+        expires_at_epoch = row.expires_at_epoch
+        if expires_at_epoch is None:
+            # 新增该列之前创建的会话
+            expires_at_epoch = row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+        _cache_session(key, user.id, expires_at_epoch)
+    else:
+        # 用户状态（禁用/管理员）仍每次读取，缓存只省去会话查询
+        user_id, expires_at_epoch = cached
+        user = db.get(User, user_id)
+    if expires_at_epoch <= time.time():
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session expired")
 
-    user: Optional[User] = db.get(User, session.user_id)
     if user is None or not user.enabled:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User disabled")
 
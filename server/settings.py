@@ -10,8 +10,13 @@ class Settings:
     """Centralized application settings with sensible defaults for Colab.
 
     Values can be overridden via environment variables when available.
+    All values are read from the environment once, when the class body runs at import.
     """
 
+    # No instance __dict__: attribute reads resolve straight to the class, and the
+    # singleton is read-only (assigning settings.X raises AttributeError).
+    __slots__ = ()
+
     # Base paths
     BASE_DIR: str = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     PUBLIC_DIR: str = os.path.join(BASE_DIR, "public")
@@ -24,6 +29,8 @@ class Settings:
     HOST: str = os.environ.get("HOST", "0.0.0.0")
     PORT: int = int(os.environ.get("PORT", "8888"))
     DISABLE_BACKGROUND: bool = os.environ.get("DISABLE_BACKGROUND", "false").lower() in {"1", "true", "yes"}
+    # 日志级别（DEBUG 时输出云雾请求/轮询明细）
+    LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "INFO").upper()
 
     # Concurrency and limits
     GLOBAL_CONCURRENCY: int = int(os.environ.get("GLOBAL_CONCURRENCY", "10"))
@@ -31,10 +38,25 @@ class Settings:
     MAX_TASKS_PER_BATCH: int = int(os.environ.get("MAX_TASKS_PER_BATCH", "50"))
     MAX_BATCHES_PER_USER_PER_MINUTE: int = int(os.environ.get("MAX_BATCHES_PER_USER_PER_MINUTE", "10"))
 
+    # Database connection pool (ignored for SQLite)
+    DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_RECYCLE: int = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+    # SQLAlchemy compiled-statement LRU cache size (per engine)
+    DB_QUERY_CACHE_SIZE: int = int(os.environ.get("DB_QUERY_CACHE_SIZE", "1200"))
+
+    # Optional Redis (shared caches / dedupe across workers); features fall back to in-process/DB when unset
+    REDIS_URL: Optional[str] = os.environ.get("REDIS_URL")
+
     # Sessions
     SESSION_COOKIE_NAME: str = os.environ.get("SESSION_COOKIE_NAME", "session_id")
     SESSION_TTL: timedelta = timedelta(days=int(os.environ.get("SESSION_TTL_DAYS", "7")))
 
+    # Password hashing cost (bcrypt log2 rounds); existing hashes keep the cost encoded in their prefix
+    BCRYPT_ROUNDS: int = int(os.environ.get("BCRYPT_ROUNDS", "10"))
+    # "bcrypt" or "argon2" (argon2id, requires argon2-cffi); logins transparently rehash to the configured scheme
+    PASSWORD_HASH_SCHEME: str = os.environ.get("PASSWORD_HASH_SCHEME", "bcrypt").lower()
+
     # Idempotency window (seconds)
     IDEMPOTENCY_WINDOW_SECONDS: int = int(os.environ.get("IDEMPOTENCY_WINDOW_SECONDS", "60"))
 
@@ -58,9 +80,12 @@ class Settings:
     PUBLIC_BASE_URL: Optional[str] = os.environ.get("PUBLIC_BASE_URL")
     # HTTP request configuration
     REQUEST_TIMEOUT_SECONDS: int = int(os.environ.get("REQUEST_TIMEOUT_SECONDS", "300"))
-    DOWNLOAD_CHUNK_SIZE: int = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", "8192"))
     POLL_INTERVAL_SECONDS: int = int(os.environ.get("POLL_INTERVAL_SECONDS", "3"))
     MAX_POLL_SECONDS: int = int(os.environ.get("MAX_POLL_SECONDS", "900"))  # 15 min
+    MAX_POLL_INTERVAL_SECONDS: int = int(os.environ.get("MAX_POLL_INTERVAL_SECONDS", "30"))
+    # 云雾任务回调：配置密钥且 PUBLIC_BASE_URL 可用时启用，轮询退化为低频兜底
+    YUNWU_CALLBACK_SECRET: Optional[str] = os.environ.get("YUNWU_CALLBACK_SECRET")
+    YUNWU_CALLBACK_FALLBACK_POLL_SECONDS: int = int(os.environ.get("YUNWU_CALLBACK_FALLBACK_POLL_SECONDS", "60"))
 
     # Aliyun SMS authentication service (SendSmsVerifyCode / CheckSmsVerifyCode)
     ALIYUN_SMS_ENDPOINT: str = os.environ.get("ALIYUN_SMS_ENDPOINT", "https://dypnsapi.aliyuncs.com")
@@ -103,9 +128,8 @@ class Settings:
     STRIPE_PUBLISHABLE_KEY: Optional[str] = os.environ.get("STRIPE_PUBLISHABLE_KEY", "")  # TODO: 填写 pk_test_... 或 pk_live_...
     STRIPE_WEBHOOK_SECRET: Optional[str] = os.environ.get("STRIPE_WEBHOOK_SECRET", "")  # TODO: 填写 whsec_...
 
-    @property
-    def BASE_URL(self) -> str:
-        return self.PUBLIC_BASE_URL or f"http://{self.HOST}:{self.PORT}"
+    # Externally reachable base URL (callbacks / payment notify); computed once
+    BASE_URL: str = PUBLIC_BASE_URL or f"http://{HOST}:{PORT}"
 
 
 settings = Settings()
@@ -1,32 +1,123 @@
 from __future__ import annotations
 
+import threading
 import time
-from collections import defaultdict, deque
-from typing import Deque, Dict
+import uuid
+from collections import OrderedDict
+from typing import List
 
 from fastapi import HTTPException, status
 
+from .redis_client import get_redis
 from .settings import settings
 
 
-class _BurstLimiter:
-    def __init__(self) -> None:
-        self.storage: Dict[str, Deque[float]] = defaultdict(deque)
+# 最多跟踪的键（手机号/IP）数量，超出时淘汰最久未访问的
+BURST_LIMITER_MAXSIZE = 50_000
+# 按键哈希分片加锁：不同手机号/IP 的检查互不串行，同一键的“检查 + 记录”仍是原子的
+BURST_LIMITER_SHARDS = 64
+
+_OK, _TOO_FREQUENT, _TOO_MANY = 0, 1, 2
+
+# 有序集合滑动窗口：裁剪过期 -> 最小间隔 -> 计数 -> 记录，一次往返且原子（多 worker 共享限额）
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local last = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if last[2] and now - tonumber(last[2]) < tonumber(ARGV[4]) then
+    return 1
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 2
+end
+redis.call('ZADD', KEYS[1], now, ARGV[5])
+redis.call('EXPIRE', KEYS[1], window)
+return 0
+"""
+
+
+def _raise_for(result: int) -> None:
+    if result == _TOO_FREQUENT:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="验证码请求过于频繁，请稍后再试")
+    if result == _TOO_MANY:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="验证码请求次数过多，请稍后再试")
+
+
+class _LRUStorage(OrderedDict):
+    """插入新键时即淘汰最久未访问的键：无论后续检查是否放行，内存都有硬上限"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class _BurstShard:
+    def __init__(self, maxsize: int) -> None:
+        # key -> [窗口秒数, 窗口起点, 窗口内次数, 最近一次时间]；按最近访问排序，队首最久未访问
+        self.storage: "_LRUStorage[str, List[float]]" = _LRUStorage(maxsize)
+        self.lock = threading.Lock()
+
+    def _sweep(self, now: float) -> None:
+        # 从最久未访问处清理窗口已结束的键，只访问过期的部分，均摊 O(1)
+        while self.storage:
+            window_seconds, window_start = next(iter(self.storage.values()))[:2]
+            if now - window_start <= window_seconds:
+                break
+            self.storage.popitem(last=False)
 
     def check(self, key: str, limit: int, window_seconds: int, min_interval_seconds: int) -> None:
+        # 固定窗口计数：每次检查 O(1)，每个键只占 4 个数，不随窗口内请求数增长
         now = time.time()
-        bucket = self.storage[key]
+        with self.lock:
+            entry = self.storage.get(key)
+            if entry is None:
+                entry = self.storage[key] = [window_seconds, now, 0, 0.0]
+            else:
+                self.storage.move_to_end(key)
+                if now - entry[1] > window_seconds:
+                    entry[1], entry[2] = now, 0
+
+            if now - entry[3] < min_interval_seconds:
+                _raise_for(_TOO_FREQUENT)
+
+            if entry[2] >= limit:
+                _raise_for(_TOO_MANY)
 
-        while bucket and now - bucket[0] > window_seconds:
-            bucket.popleft()
+            entry[2] += 1
+            entry[3] = now
+            self._sweep(now)
 
-        if bucket and now - bucket[-1] < min_interval_seconds:
-            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="验证码请求过于频繁，请稍后再试")
 
-        if len(bucket) >= limit:
-            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="验证码请求次数过多，请稍后再试")
+class _BurstLimiter:
+    """配置了 Redis 时限额在所有 worker 间共享（有序集合 + Lua），否则或 Redis 不可用时退化为进程内分片计数"""
+
+    def __init__(self, maxsize: int = BURST_LIMITER_MAXSIZE, shards: int = BURST_LIMITER_SHARDS) -> None:
+        self._shards = [_BurstShard(max(1, maxsize // shards)) for _ in range(shards)]
+        self._script = None
 
-        bucket.append(now)
+    def check(self, key: str, limit: int, window_seconds: int, min_interval_seconds: int) -> None:
+        redis_client = get_redis()
+        if redis_client is not None:
+            try:
+                if self._script is None:
+                    self._script = redis_client.register_script(_SLIDING_WINDOW_LUA)
+                result = self._script(
+                    keys=[f"sms:rl:{key}"],
+                    args=[time.time(), window_seconds, limit, min_interval_seconds, uuid.uuid4().hex],
+                )
+            except Exception as e:
+                print(f"[sms_rate_limit] redis unavailable, using local limiter: {e}")
+            else:
+                _raise_for(int(result))
+                return
+        shard = self._shards[hash(key) % len(self._shards)]
+        shard.check(key, limit, window_seconds, min_interval_seconds)
 
 
 limiter = _BurstLimiter()
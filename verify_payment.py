@@ -1,78 +1,93 @@
-import requests
+import asyncio
 import sys
 
+import httpx
+
 BASE_URL = "http://127.0.0.1:8000"
 
-def verify_payment_flow():
-    # 1. Login
-    print("1. Logging in...")
-    s = requests.Session()
-    # Create a new user for testing
-    mobile = "13911112222"
-    # Send code
-    s.post(f"{BASE_URL}/api/mobile/send-code", json={"mobile": mobile, "scene": "login"})
-    # Verify code (mock code is 123456)
-    res = s.post(f"{BASE_URL}/api/mobile/verify", json={"mobile": mobile, "code": "123456", "scene": "login"})
-    if res.status_code != 200:
-        print("Login failed:", res.text)
-        sys.exit(1)
-    
-    user_data = res.json()["data"]
-    user_id = user_data["user_id"]
-    initial_credits = user_data["credits"]
-    print(f"Logged in as {user_id}, credits: {initial_credits}")
-
-    # 2. Create Recharge Order
-    print("2. Creating recharge order...")
-    res = s.post(f"{BASE_URL}/api/recharge/orders", json={
-        "amount": 10.0,
-        "payment_method": "alipay"
-    })
-    if res.status_code != 200:
-        print("Create order failed:", res.text)
-        sys.exit(1)
-    
-    order_data = res.json()["data"]
-    order_id = order_data["order_id"]
-    print(f"Order created: {order_id}")
-
-    # 3. Check Status (Pending)
-    print("3. Checking status (should be pending)...")
-    res = s.get(f"{BASE_URL}/api/recharge/orders/{order_id}/status")
-    status = res.json()["data"]["status"]
-    if status != "pending":
-        print(f"Unexpected status: {status}")
-        sys.exit(1)
-    print("Status is pending.")
-
-    # 4. Mock Pay
-    print("4. Executing Mock Pay...")
-    res = s.post(f"{BASE_URL}/api/mock/pay/{order_id}")
-    if res.status_code != 200:
-        print("Mock pay failed:", res.text)
-        sys.exit(1)
-    print("Mock pay success.")
-
-    # 5. Check Status (Paid)
-    print("5. Checking status (should be paid)...")
-    res = s.get(f"{BASE_URL}/api/recharge/orders/{order_id}/status")
-    status = res.json()["data"]["status"]
-    if status != "paid":
-        print(f"Unexpected status: {status}")
-        sys.exit(1)
-    print("Status is paid.")
-
-    # 6. Verify Credits
-    print("6. Verifying credits increased...")
-    res = s.get(f"{BASE_URL}/api/me")
-    new_credits = res.json()["data"]["credits"]
-    expected_credits = initial_credits + 100 # 10.0 -> 100 credits
-    if new_credits != expected_credits:
-        print(f"Credits mismatch! Expected {expected_credits}, got {new_credits}")
-        sys.exit(1)
-    print(f"Credits verified: {new_credits}")
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install httpx[http2]）
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+
+async def verify_payment_flow():
+    # 所有请求共用一个客户端与连接池；服务端支持时走 HTTP/2 多路复用，否则复用 keep-alive 连接
+    # 不自动重试（诊断脚本，失败应直接暴露）
+    async with httpx.AsyncClient(base_url=BASE_URL, http2=HAS_HTTP2) as s:
+        # 预热连接，后续各步骤复用
+        await s.get("/api/health")
+
+        # 1. Login
+        print("1. Logging in...")
+        # Create a new user for testing
+        mobile = "13911112222"
+        # Send code
+        await s.post("/api/mobile/send-code", json={"mobile": mobile, "scene": "login"})
+        # Verify code (mock code is 123456)
+        res = await s.post("/api/mobile/verify", json={"mobile": mobile, "code": "123456", "scene": "login"})
+        if res.status_code != 200:
+            print("Login failed:", res.text)
+            sys.exit(1)
+
+        user_data = res.json()["data"]
+        user_id = user_data["user_id"]
+        initial_credits = user_data["credits"]
+        print(f"Logged in as {user_id}, credits: {initial_credits}")
+
+        # 2. Create Recharge Order
+        print("2. Creating recharge order...")
+        res = await s.post("/api/recharge/orders", json={
+            "amount": 10.0,
+            "payment_method": "alipay"
+        })
+        if res.status_code != 200:
+            print("Create order failed:", res.text)
+            sys.exit(1)
+
+        order_data = res.json()["data"]
+        order_id = order_data["order_id"]
+        print(f"Order created: {order_id}")
+
+        # 3. Check Status (Pending)
+        print("3. Checking status (should be pending)...")
+        res = await s.get(f"/api/recharge/orders/{order_id}/status")
+        status = res.json()["data"]["status"]
+        if status != "pending":
+            print(f"Unexpected status: {status}")
+            sys.exit(1)
+        print("Status is pending.")
+
+        # 4. Mock Pay
+        print("4. Executing Mock Pay...")
+        res = await s.post(f"/api/mock/pay/{order_id}")
+        if res.status_code != 200:
+            print("Mock pay failed:", res.text)
+            sys.exit(1)
+        print("Mock pay success.")
+
+        # 5 & 6 都只依赖支付完成，互不依赖：并发发出
+        print("5. Checking status (should be paid) and 6. verifying credits increased...")
+        status_res, me_res = await asyncio.gather(
+            s.get(f"/api/recharge/orders/{order_id}/status"),
+            s.get("/api/me"),
+        )
+
+        status = status_res.json()["data"]["status"]
+        if status != "paid":
+            print(f"Unexpected status: {status}")
+            sys.exit(1)
+        print("Status is paid.")
+
+        new_credits = me_res.json()["data"]["credits"]
+        expected_credits = initial_credits + 100 # 10.0 -> 100 credits
+        if new_credits != expected_credits:
+            print(f"Credits mismatch! Expected {expected_credits}, got {new_credits}")
+            sys.exit(1)
+        print(f"Credits verified: {new_credits}")
 
     print("\n✅ Payment Flow Verified Successfully!")
 
 if __name__ == "__main__":
-    verify_payment_flow()
+    asyncio.run(verify_payment_flow())